@@ -1,12 +1,19 @@
 # adapters/avito_poller.py
 import asyncio
 import os
+import re
 import time
-from typing import Any, Dict, List, Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Set, Tuple, TypeVar
 
 from core.avito_api import AvitoAPI
 from core.app_state import AppState
 
+T = TypeVar("T")
+
 
 HUMAN_TRIGGERS = [
     "оператор", "менеджер", "живой человек", "человек", "ассистент",
@@ -23,6 +30,21 @@ STRONG_SERVICE_KEYWORDS = [
 ]
 
 
+def _norm(s: str) -> str:
+    return (s or "").strip().lower()
+
+
+def _needles_re(needles: List[str]) -> "re.Pattern[str]":
+    # Один проход по тексту (alternation в C-движке re) вместо N проверок `in` на каждое сообщение.
+    # Иглы нормализуем один раз при импорте; длинные — первыми.
+    parts = sorted({_norm(n) for n in needles if _norm(n)}, key=len, reverse=True)
+    return re.compile("|".join(re.escape(p) for p in parts))
+
+
+HUMAN_RE = _needles_re(HUMAN_TRIGGERS)
+STRONG_SERVICE_RE = _needles_re(STRONG_SERVICE_KEYWORDS)
+
+
 def _parse_csv_env(name: str) -> List[str]:
     raw = (os.getenv(name, "") or "").strip()
     if not raw:
@@ -31,81 +53,113 @@ def _parse_csv_env(name: str) -> List[str]:
     return [p for p in parts if p]
 
 
-def _title_allowed(title: str, allowed: List[str]) -> bool:
-    if not allowed:
+def _title_allowed(title_n: str, allowed_set: FrozenSet[str], allowed_re: Optional["re.Pattern[str]"]) -> bool:
+    # title_n и allowed_* уже нормализованы (_norm).
+    # Обычно заголовок совпадает с allowlist целиком — это хэш-поиск; иначе один проход regex по подстрокам.
+    if allowed_re is None:
         return True
-    t = _norm(title)
-    return any(_norm(a) in t for a in allowed)
+    return title_n in allowed_set or allowed_re.search(title_n) is not None
 
 
-def _norm(s: str) -> str:
-    return (s or "").strip().lower()
+def _contains_any(text_n: str, needles_re: "re.Pattern[str]") -> bool:
+    # text_n — уже после _norm: нормализуем сообщение один раз на все проверки
+    return needles_re.search(text_n) is not None
 
 
-def _contains_any(text: str, needles: List[str]) -> bool:
-    t = _norm(text)
-    return any(_norm(n) in t for n in needles if n)
+# Варианты имён полей в ответах Авито (v1/v2 отличаются) — собраны один раз
+_CHAT_ID_KEYS = ("id", "chat_id", "chatId")
+_CHAT_URL_KEYS = ("url", "web_url", "webUrl")
+_PRICE_KEYS = ("price_string", "priceString")
+_LAST_MSG_KEYS = ("last_message", "lastMessage", "last_message_info")
+_UNREAD_KEYS = ("unread_count", "unreadCount")
+_MSG_ID_KEYS = ("id", "message_id", "messageId")
+_MSG_TEXT_KEYS = ("content", "message")
+_AUTHOR_KEYS = ("author_id", "authorId")
+_IN_DIRECTIONS = frozenset(("in", "incoming"))
+_OUT_DIRECTIONS = frozenset(("out", "outgoing"))
+
+
+def _first(d: Dict[str, Any], keys: Tuple[str, ...]) -> Any:
+    # то же, что d.get(k1) or d.get(k2) or ... (включая возврат последнего значения)
+    v = None
+    for k in keys:
+        v = d.get(k)
+        if v:
+            return v
+    return v
 
 
 def _pick_chat_id(chat: Dict[str, Any]) -> Optional[str]:
-    cid = chat.get("id") or chat.get("chat_id") or chat.get("chatId")
+    cid = _first(chat, _CHAT_ID_KEYS)
     return str(cid) if cid is not None else None
 
 
 def _extract_meta(chat_obj: Dict[str, Any]) -> Dict[str, str]:
-    chat_url = str(chat_obj.get("url") or chat_obj.get("web_url") or chat_obj.get("webUrl") or "")
+    chat_url = str(_first(chat_obj, _CHAT_URL_KEYS) or "")
     ctx = chat_obj.get("context") or {}
-    val = ctx.get("value") if isinstance(ctx.get("value"), dict) else {}
-
-    title = str(val.get("title") or "")
-    item_url = str(val.get("url") or "")
-    price_string = str(val.get("price_string") or val.get("priceString") or "")
+    val = ctx.get("value")
+    if not isinstance(val, dict):
+        val = {}
 
-    loc = val.get("location") if isinstance(val.get("location"), dict) else {}
-    location_title = str((loc or {}).get("title") or "")
+    loc = val.get("location")
+    if not isinstance(loc, dict):
+        loc = {}
 
     return {
-        "title": title,
-        "item_url": item_url,
+        "title": str(val.get("title") or ""),
+        "item_url": str(val.get("url") or ""),
         "chat_url": chat_url,
-        "city": location_title,
-        "price_string": price_string,
+        "city": str(loc.get("title") or ""),
+        "price_string": str(_first(val, _PRICE_KEYS) or ""),
     }
 
 
 def _get_last_message(chat_obj: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-    lm = chat_obj.get("last_message") or chat_obj.get("lastMessage") or chat_obj.get("last_message_info")
+    lm = _first(chat_obj, _LAST_MSG_KEYS)
     return lm if isinstance(lm, dict) else None
 
 
+def _unread_count(chat_obj: Dict[str, Any]) -> Optional[int]:
+    # None — поля нет в ответе (тогда по нему не фильтруем)
+    for k in _UNREAD_KEYS:
+        v = chat_obj.get(k)
+        if v is not None:
+            try:
+                return int(v)
+            except Exception:
+                return None
+    return None
+
+
 def _msg_id(m: Dict[str, Any]) -> str:
-    mid = m.get("id") or m.get("message_id") or m.get("messageId")
+    mid = _first(m, _MSG_ID_KEYS)
     return str(mid) if mid is not None else ""
 
 
 def _msg_text(m: Dict[str, Any]) -> str:
-    content = m.get("content") or {}
-    if isinstance(content, dict) and isinstance(content.get("text"), str):
-        return content["text"].strip()
-
-    msg = m.get("message") or {}
-    if isinstance(msg, dict) and isinstance(msg.get("text"), str):
-        return msg["text"].strip()
-
-    if isinstance(m.get("text"), str):
-        return m["text"].strip()
+    # content.text -> message.text -> text
+    for k in _MSG_TEXT_KEYS:
+        sub = m.get(k)
+        if isinstance(sub, dict):
+            t = sub.get("text")
+            if isinstance(t, str):
+                return t.strip()
+
+    t = m.get("text")
+    if isinstance(t, str):
+        return t.strip()
 
     return ""
 
 
 def _is_incoming(m: Dict[str, Any], my_user_id: int) -> bool:
-    direction = (m.get("direction") or "").lower().strip()
-    if direction in ("in", "incoming"):
+    direction: str = str(m.get("direction") or "").lower().strip()
+    if direction in _IN_DIRECTIONS:
         return True
-    if direction in ("out", "outgoing"):
+    if direction in _OUT_DIRECTIONS:
         return False
 
-    author = m.get("author_id") or m.get("authorId")
+    author = _first(m, _AUTHOR_KEYS)
     try:
         if author is not None and int(author) == int(my_user_id):
             return False
@@ -114,221 +168,384 @@ def _is_incoming(m: Dict[str, Any], my_user_id: int) -> bool:
     return True
 
 
-async def run_avito_poller(state: AppState) -> None:
-    client_id = os.getenv("AVITO_CLIENT_ID", "").strip()
-    client_secret = os.getenv("AVITO_CLIENT_SECRET", "").strip()
-    token_path = os.getenv("AVITO_TOKEN_PATH", "data/avito_tokens.json").strip()
-    user_id = int(os.getenv("AVITO_USER_ID", "0") or "0")
-
-    poll_interval = float(os.getenv("AVITO_POLL_INTERVAL", "3"))
-    manual_hours = float(os.getenv("AVITO_MANUAL_HOURS", "6"))
+@dataclass(frozen=True)
+class AvitoConfig:
+    """Настройки poller'а: читаются из env один раз при старте."""
+
+    client_id: str
+    client_secret: str
+    token_path: str
+    user_id: int
+    poll_min: float
+    poll_max: float
+    manual_hours: float
+    debug: bool
+    unread_only: bool
+    allowed_set: FrozenSet[str]
+    allowed_re: Optional["re.Pattern[str]"]
+    trace_chat_id: str
+    concurrency: int
+    ignore_backlog_on_start: bool
+    http2: bool
+
+    @classmethod
+    def from_env(cls) -> "AvitoConfig":
+        poll_interval = float(os.getenv("AVITO_POLL_INTERVAL", "3"))
+        # ✅ Адаптивный интервал: пока новых сообщений нет — опрашиваем всё реже (до AVITO_POLL_MAX),
+        # после любого нового входящего — снова с минимального.
+        poll_min = float(os.getenv("AVITO_POLL_MIN", "") or poll_interval)
+
+        # ✅ Опционально: allowlist по заголовкам объявлений.
+        # Пример в .env:
+        # AVITO_ALLOWED_TITLES=Натяжные потолки в Ижевске,Шумоизоляция и звукоизоляция под ключ
+        allowed_titles = _parse_csv_env("AVITO_ALLOWED_TITLES")
+        allowed_set = frozenset(_norm(a) for a in allowed_titles if _norm(a))
+
+        return cls(
+            client_id=os.getenv("AVITO_CLIENT_ID", "").strip(),
+            client_secret=os.getenv("AVITO_CLIENT_SECRET", "").strip(),
+            token_path=os.getenv("AVITO_TOKEN_PATH", "data/avito_tokens.json").strip(),
+            user_id=int(os.getenv("AVITO_USER_ID", "0") or "0"),
+            poll_min=poll_min,
+            poll_max=max(poll_min, float(os.getenv("AVITO_POLL_MAX", "30"))),
+            manual_hours=float(os.getenv("AVITO_MANUAL_HOURS", "6")),
+            debug=os.getenv("AVITO_DEBUG", "0") == "1",
+            # ✅ Чаты без непрочитанных пропускаем сразу (если Авито отдаёт счётчик)
+            unread_only=os.getenv("AVITO_UNREAD_ONLY", "1") == "1",
+            allowed_set=allowed_set,
+            allowed_re=_needles_re(allowed_titles) if allowed_set else None,
+            # ⚠️ Если у тебя в .env было AVITO_TRACE_CHAT_ID — оно режет всё до одного чата.
+            # Оставляем как "отладочный" флаг, но если хочешь отвечать всем — просто не задавай его.
+            trace_chat_id=os.getenv("AVITO_TRACE_CHAT_ID", "").strip(),
+            concurrency=max(1, int(os.getenv("AVITO_CONCURRENCY", "8"))),
+            # ✅ На старте НЕ отвечаем на старые сообщения.
+            # Идея: делаем "снимок" последних входящих сообщений по всем чатам и сохраняем их как уже обработанные.
+            # Тогда бот будет отвечать только на новые сообщения, которые появятся ПОСЛЕ запуска.
+            ignore_backlog_on_start=os.getenv("AVITO_IGNORE_BACKLOG_ON_START", "1") == "1",
+            # HTTP/2 к api.avito.ru (pip install "httpx[http2]"); без h2 тихо остаётся HTTP/1.1
+            http2=os.getenv("AVITO_HTTP2", "0") == "1",
+        )
+
+
+def _skip_reason(cfg: AvitoConfig, title_n: str, text_n: str, mem: Dict[str, Any], now: float) -> str:
+    """Почему не отвечаем на новое входящее ("" — отвечаем). Все проверки без побочных эффектов."""
+    # ✅ Allowlist по объявлениям (если задано)
+    if title_n and not _title_allowed(title_n, cfg.allowed_set, cfg.allowed_re):
+        return "title not allowed"
+
+    # ✅ Тема: только по «сильным» ключам
+    if not (_contains_any(text_n, STRONG_SERVICE_RE) or _contains_any(title_n, STRONG_SERVICE_RE)):
+        return "not our service topic"
+
+    # менеджер уже ведёт чат вручную
+    if float(mem.get("manual_until") or 0) > now:
+        return "manual mode"
 
-    debug = os.getenv("AVITO_DEBUG", "0") == "1"
+    return ""
 
-    # ✅ Опционально: allowlist по заголовкам объявлений.
-    # Пример в .env:
-    # AVITO_ALLOWED_TITLES=Натяжные потолки в Ижевске,Шумоизоляция и звукоизоляция под ключ
-    allowed_titles = _parse_csv_env("AVITO_ALLOWED_TITLES")
 
-    # ⚠️ Если у тебя в .env было AVITO_TRACE_CHAT_ID — оно режет всё до одного чата.
-    # Оставляем как "отладочный" флаг, но если хочешь отвечать всем — просто не задавай его.
-    trace_chat_id = os.getenv("AVITO_TRACE_CHAT_ID", "").strip()
+async def run_avito_poller(state: AppState) -> None:
+    cfg = AvitoConfig.from_env()
 
-    if not client_id or not client_secret or not user_id:
+    if not cfg.client_id or not cfg.client_secret or not cfg.user_id:
         raise RuntimeError("Нужно заполнить AVITO_CLIENT_ID, AVITO_CLIENT_SECRET, AVITO_USER_ID")
 
     api = AvitoAPI(
-        client_id=client_id,
-        client_secret=client_secret,
-        user_id=user_id,
-        token_path=token_path,
+        client_id=cfg.client_id,
+        client_secret=cfg.client_secret,
+        user_id=cfg.user_id,
+        token_path=cfg.token_path,
+        # запас соединений на параллельные чаты + token_refresher
+        max_connections=cfg.concurrency * 2,
+        http2=cfg.http2,
     )
 
-    # ✅ На старте НЕ отвечаем на старые сообщения.
-    # Идея: делаем "снимок" последних входящих сообщений по всем чатам и сохраняем их как уже обработанные.
-    # Тогда бот будет отвечать только на новые сообщения, которые появятся ПОСЛЕ запуска.
-    ignore_backlog_on_start = os.getenv("AVITO_IGNORE_BACKLOG_ON_START", "1") == "1"
-
-    async def token_refresher():
-        while True:
-            await asyncio.sleep(23 * 3600)
-            try:
-                await asyncio.to_thread(api.refresh_token)
-            except Exception:
-                pass
+    # Свой пул потоков под HTTP-вызовы Авито: не делим дефолтный executor asyncio
+    # (его же используют to_thread для generate_reply, DNS и т.п.)
+    # AvitoAPI рассчитан на параллельные вызовы: httpx.Client потокобезопасен,
+    # токен и ETag-кэш защищены локами внутри клиента.
+    pool = ThreadPoolExecutor(max_workers=cfg.concurrency * 2, thread_name_prefix="avito")
+    loop = asyncio.get_running_loop()
 
-    asyncio.create_task(token_refresher())
+    async def _run(fn: Callable[..., T], *args: Any) -> T:
+        return await loop.run_in_executor(pool, partial(fn, *args))
 
-    print("[avito_poller] mode: LAST_MESSAGE (GET messages is not available: 405/404)")
-
-    if ignore_backlog_on_start:
-        try:
-            await asyncio.to_thread(api.ensure_token)
-            boot_cnt = 0
-            limit = 100
-            offset = 0
-            # ⚠️ Важно: на аккаунте может быть >100 чатов.
-            # Пролистываем все страницы, иначе бот «догонит» историю и будет спамить.
-            while True:
-                chats0 = await asyncio.to_thread(api.list_chats, limit, offset)
-                if not chats0:
-                    break
-                for ch0 in chats0:
-                    chat_id0 = _pick_chat_id(ch0)
-                    if not chat_id0:
-                        continue
-                    last0 = _get_last_message(ch0)
-                    if not last0:
-                        continue
-                    mid0 = _msg_id(last0)
-                    txt0 = _msg_text(last0)
-                    incoming0 = _is_incoming(last0, user_id)
-                    if not mid0 or not txt0 or not incoming0:
-                        continue
-
-                    k0 = f"avito:{chat_id0}"
-                    mem0: Dict[str, Any] = state.mem_store.load(k0)
-                    mem0["avito_last_in_mid"] = mid0
-                    state.mem_store.save(k0, mem0)
-                    boot_cnt += 1
-
-                if len(chats0) < limit:
-                    break
-                offset += limit
-
-            print(f"[avito_poller] bootstrap: ignored backlog for {boot_cnt} chats")
-        except Exception as e:
-            print(f"[avito_poller] bootstrap error: {e}")
-
-    while True:
-        try:
-            await asyncio.to_thread(api.ensure_token)
-            # Листаем все страницы, иначе новые сообщения в «дальних» чатах не будут обрабатываться.
-            limit = 100
-            offset = 0
-            total = 0
+    refresher: Optional[asyncio.Task] = None
+    try:
+        async def token_refresher() -> None:
             while True:
-                chats = await asyncio.to_thread(api.list_chats, limit, offset)
-                if not chats:
-                    break
-                total += len(chats)
-
-                if debug and offset == 0:
-                    print(f"[avito_poller] tick: first_page_chats={len(chats)}")
-
-                for ch in chats:
-                    chat_id = _pick_chat_id(ch)
-                    if not chat_id:
-                        continue
-
-                    # ✅ Отладка (по умолчанию пусто). Если заполнено — режет до одного чата.
-                    if trace_chat_id and chat_id != trace_chat_id:
-                        continue
-
-                    last = _get_last_message(ch)
-                    if not last:
-                        continue
-
-                    mid = _msg_id(last)
-                    text = _msg_text(last)
-                    incoming = _is_incoming(last, user_id)
-
-                    # отвечаем ТОЛЬКО на новые входящие от клиента
-                    if not text or not mid or not incoming:
-                        continue
-
-                    k = f"avito:{chat_id}"
-                    mem_before: Dict[str, Any] = state.mem_store.load(k)
-
-                    # ✅ анти-дубль: уже обработали этот incoming
-                    if str(mem_before.get("avito_last_in_mid") or "") == mid:
-                        continue
-
-                    meta = _extract_meta(ch)
-                    title = meta.get("title", "")
-
-                    # ✅ Allowlist по объявлениям (если задано)
-                    if title and not _title_allowed(title, allowed_titles):
-                        mem_before["avito_last_in_mid"] = mid
-                        state.mem_store.save(k, mem_before)
-                        if debug:
-                            print("[TRACE] skip: title not allowed")
-                        continue
-
-                    if debug:
-                        print(f"[TRACE] chat={chat_id} title='{title}' last_id={mid} in={incoming} text={text!r}")
-
-                    # ✅ Тема: только по «сильным» ключам
-                    if not (_contains_any(text, STRONG_SERVICE_KEYWORDS) or _contains_any(title, STRONG_SERVICE_KEYWORDS)):
-                        mem_before["avito_last_in_mid"] = mid
-                        state.mem_store.save(k, mem_before)
-                        if debug:
-                            print("[TRACE] skip: not our service topic")
-                        continue
-
-                    now = time.time()
-                    manual_until = float(mem_before.get("manual_until") or 0)
-                    if manual_until > now:
-                        mem_before["avito_last_in_mid"] = mid
-                        state.mem_store.save(k, mem_before)
-                        continue
-
-                    # 🆘 запрос менеджера
-                    if _contains_any(text, HUMAN_TRIGGERS):
-                        mem_before["manual_until"] = now + manual_hours * 3600
-                        mem_before["manual_started_at"] = now
-                        mem_before["manual_reason"] = "client_requested_human"
-                        mem_before["avito_last_in_mid"] = mid
-                        state.mem_store.save(k, mem_before)
-
-                        link = meta.get("chat_url") or meta.get("item_url") or "https://www.avito.ru/profile/messenger"
-                        state.notify_now(
-                            "🆘 Клиент просит менеджера (Авито)\n"
-                            f"Chat ID: {chat_id}\n"
-                            f"Объявление: {title or '-'}\n"
-                            f"Ссылка: {link}\n"
-                            f"Сообщение:\n{text}"
-                        )
-                        try:
-                            await asyncio.to_thread(api.send_text, chat_id, "Поняла ✅ Передала менеджеру — он ответит вам в чате.")
-                        except Exception:
-                            pass
-                        continue
-
-                    # ✅ Генерация ответа
-                    reply = await asyncio.to_thread(
-                        state.generate_reply,
-                        "avito",
-                        chat_id,
-                        text,
-                        meta,
-                    )
+                await asyncio.sleep(23 * 3600)
+                try:
+                    await _run(api.refresh_token)
+                except Exception:
+                    pass
 
-                    if reply and reply.strip():
-                        try:
-                            await asyncio.to_thread(api.send_text, chat_id, reply)
-                        except Exception as e:
-                            print(f"[avito_poller] send error: {e}")
+        refresher = asyncio.create_task(token_refresher())
 
-                    try:
-                        await asyncio.to_thread(api.mark_read, chat_id)
-                    except Exception:
-                        pass
+        # память чатов: state.mem_store уже буферизован (LRU + отложенная запись),
+        # load() отдаёт свою копию; пишем один раз за обработку чата
+        mem_store = state.mem_store
 
-                    # ✅ Запоминаем последний входящий mid
-                    mem_after: Dict[str, Any] = state.mem_store.load(k)
-                    mem_after["avito_last_in_mid"] = mid
-                    state.mem_store.save(k, mem_after)
+        # chat_id -> последний обработанный входящий mid (первый уровень анти-дубля, без похода в память)
+        last_mids: "OrderedDict[str, str]" = OrderedDict()
+        last_mids_max = 10000
 
-                # pagination
-                if len(chats) < limit:
-                    break
-                offset += limit
+        def _remember_mid(chat_id: str, mid: str) -> None:
+            last_mids[chat_id] = mid
+            last_mids.move_to_end(chat_id)
+            if len(last_mids) > last_mids_max:
+                last_mids.popitem(last=False)
 
-            if debug:
-                print(f"[avito_poller] tick done: chats_scanned={total}")
+        print("[avito_poller] mode: LAST_MESSAGE (GET messages is not available: 405/404)")
 
-        except Exception as e:
-            print(f"[avito_poller] LOOP ERROR: {e}")
+        if cfg.ignore_backlog_on_start:
+            try:
+                await _run(api.ensure_token)
+                boot_cnt = 0
+                limit = 100
+                offset = 0
+                # ⚠️ Важно: на аккаунте может быть >100 чатов.
+                # Пролистываем все страницы, иначе бот «догонит» историю и будет спамить.
+                while True:
+                    chats0 = await _run(api.list_chats, limit, offset)
+                    if not chats0:
+                        break
+                    for ch0 in chats0:
+                        chat_id0 = _pick_chat_id(ch0)
+                        if not chat_id0:
+                            continue
+                        last0 = _get_last_message(ch0)
+                        if not last0:
+                            continue
+                        mid0 = _msg_id(last0)
+                        txt0 = _msg_text(last0)
+                        incoming0 = _is_incoming(last0, cfg.user_id)
+                        if not mid0 or not txt0 or not incoming0:
+                            continue
+
+                        k0 = f"avito:{chat_id0}"
+                        mem0: Dict[str, Any] = mem_store.load(k0)
+                        mem0["avito_last_in_mid"] = mid0
+                        mem_store.save(k0, mem0, owned=True)
+                        _remember_mid(chat_id0, mid0)
+                        boot_cnt += 1
+
+                    if len(chats0) < limit:
+                        break
+                    offset += limit
+
+                print(f"[avito_poller] bootstrap: ignored backlog for {boot_cnt} chats")
+            except Exception as e:
+                print(f"[avito_poller] bootstrap error: {e}")
+
+        # chat_id -> поле "updated" из списка чатов на момент последней обработки.
+        # Если не изменилось — в чате ничего нового, в mem_store не ходим.
+        seen_updated: Dict[str, Any] = {}
+
+        async def _handle_chat(ch: Dict[str, Any], chat_id: str, mid: str, text: str) -> bool:
+            """Новое входящее в чате. True — сообщение действительно новое (не дубль)."""
+            k = f"avito:{chat_id}"
+            mem: Dict[str, Any] = mem_store.load(k)
+
+            # ✅ анти-дубль: уже обработали этот incoming
+            if str(mem.get("avito_last_in_mid") or "") == mid:
+                _remember_mid(chat_id, mid)
+                return False
+
+            # mem сохраняем один раз в finally и только если меняли:
+            # если упали посреди обработки — mid не запомнится и чат перечитается
+            dirty = False
+            try:
+                meta = _extract_meta(ch)
+                title = meta.get("title", "")
+                text_n = _norm(text)
+                title_n = _norm(title)
+
+                if cfg.debug:
+                    print(f"[TRACE] chat={chat_id} title='{title}' last_id={mid} text={text!r}")
+
+                now = time.time()
+                reason = _skip_reason(cfg, title_n, text_n, mem, now)
+                if reason:
+                    mem["avito_last_in_mid"] = mid
+                    dirty = True
+                    if cfg.debug:
+                        print(f"[TRACE] skip: {reason}")
+                    return True
+
+                # 🆘 запрос менеджера
+                if _contains_any(text_n, HUMAN_RE):
+                    mem["manual_until"] = now + cfg.manual_hours * 3600
+                    mem["manual_started_at"] = now
+                    mem["manual_reason"] = "client_requested_human"
+                    mem["avito_last_in_mid"] = mid
+                    dirty = True
+
+                    link = meta.get("chat_url") or meta.get("item_url") or "https://www.avito.ru/profile/messenger"
+                    state.notify_now(
+                        "🆘 Клиент просит менеджера (Авито)\n"
+                        f"Chat ID: {chat_id}\n"
+                        f"Объявление: {title or '-'}\n"
+                        f"Ссылка: {link}\n"
+                        f"Сообщение:\n{text}"
+                    )
+                    try:
+                        await _run(api.send_text, chat_id, "Поняла ✅ Передала менеджеру — он ответит вам в чате.")
+                    except Exception:
+                        pass
+                    return True
+
+                # ✅ Генерация ответа
+                reply = await asyncio.to_thread(
+                    state.generate_reply,
+                    "avito",
+                    chat_id,
+                    text,
+                    meta,
+                )
+                # generate_reply сам сохраняет память по этому же ключу — перечитываем один раз
+                mem = mem_store.load(k)
+
+                # отправка и mark_read независимы — выполняем одновременно
+                send_res, read_res = await asyncio.gather(
+                    _run(api.send_text, chat_id, reply) if reply and reply.strip() else asyncio.sleep(0),
+                    _run(api.mark_read, chat_id),
+                    return_exceptions=True,
+                )
+                if isinstance(send_res, Exception):
+                    print(f"[avito_poller] send error: {send_res}")
+                if cfg.debug and isinstance(read_res, Exception):
+                    print(f"[avito_poller] mark_read error: {read_res}")
+
+                # ✅ Запоминаем последний входящий mid
+                mem["avito_last_in_mid"] = mid
+                dirty = True
+                return True
+            finally:
+                if dirty:
+                    mem_store.save(k, mem, owned=True)
+                    _remember_mid(chat_id, mid)
+
+        sem = asyncio.Semaphore(cfg.concurrency)
+
+        # Один и тот же чат не обрабатываем параллельно (load -> modify -> save памяти атомарны в пределах чата),
+        # разные чаты — параллельно. Свободные локи чистим в конце тика.
+        chat_locks: Dict[str, asyncio.Lock] = {}
+
+        def _lock_for(chat_id: str) -> asyncio.Lock:
+            lock = chat_locks.get(chat_id)
+            if lock is None:
+                lock = chat_locks[chat_id] = asyncio.Lock()
+            return lock
+
+        async def _process_chat(ch: Dict[str, Any]) -> bool:
+            """Дешёвые проверки по объекту чата из списка; тяжёлая часть — в _handle_chat."""
+            chat_id = _pick_chat_id(ch)
+            if not chat_id:
+                return False
+
+            # ✅ Отладка (по умолчанию пусто). Если заполнено — режет до одного чата.
+            if cfg.trace_chat_id and chat_id != cfg.trace_chat_id:
+                return False
+
+            if cfg.unread_only and _unread_count(ch) == 0:
+                return False
+
+            updated = ch.get("updated")
+            if updated is not None:
+                if seen_updated.get(chat_id) == updated:
+                    return False
+                seen_updated[chat_id] = updated
+
+            last = _get_last_message(ch)
+            if not last:
+                return False
+
+            mid = _msg_id(last)
+            text = _msg_text(last)
+            incoming = _is_incoming(last, cfg.user_id)
+
+            # отвечаем ТОЛЬКО на новые входящие от клиента
+            if not text or not mid or not incoming:
+                return False
+
+            if last_mids.get(chat_id) == mid:
+                return False
+
+            # ✅ Чаты страницы обрабатываем параллельно, но не больше AVITO_CONCURRENCY одновременно
+            # и не больше одной задачи на чат. Сначала лок чата, потом семафор: задача, ждущая
+            # свой чат, не должна занимать слот параллельности.
+            async with _lock_for(chat_id), sem:
+                try:
+                    return await _handle_chat(ch, chat_id, mid, text)
+                except Exception:
+                    # чат, на котором упали, должен перечитаться на следующем тике
+                    seen_updated.pop(chat_id, None)
+                    raise
+
+        idle_ticks = 0
+        cur_sleep = cfg.poll_min
 
-        await asyncio.sleep(float(poll_interval))
\ No newline at end of file
+        while True:
+            new_in = 0
+            try:
+                await _run(api.ensure_token)
+                # Листаем все страницы, иначе новые сообщения в «дальних» чатах не будут обрабатываться.
+                limit = 100
+                offset = 0
+                total = 0
+                # чат мог попасть на две страницы (список сдвинулся) или повториться в одной — берём один раз за тик
+                tick_ids: Set[str] = set()
+                while True:
+                    chats = await _run(api.list_chats, limit, offset)
+                    if not chats:
+                        break
+                    total += len(chats)
+
+                    if cfg.debug and offset == 0:
+                        print(f"[avito_poller] tick: first_page_chats={len(chats)}")
+
+                    batch: List[Dict[str, Any]] = []
+                    for ch in chats:
+                        cid = _pick_chat_id(ch)
+                        if not cid or cid in tick_ids:
+                            continue
+                        tick_ids.add(cid)
+                        batch.append(ch)
+
+                    results = await asyncio.gather(*[_process_chat(ch) for ch in batch], return_exceptions=True)
+                    for r in results:
+                        if isinstance(r, BaseException):
+                            print(f"[avito_poller] chat error: {r}")
+                        elif r:
+                            new_in += 1
+
+                    # pagination
+                    if len(chats) < limit:
+                        break
+                    offset += limit
+
+                if cfg.debug:
+                    print(f"[avito_poller] tick done: chats_scanned={total}")
+
+                for cid in [c for c, lock in chat_locks.items() if not lock.locked()]:
+                    del chat_locks[cid]
+
+            except Exception as e:
+                # список не дочитали — на следующем тике перечитываем все чаты
+                seen_updated.clear()
+                print(f"[avito_poller] LOOP ERROR: {e}")
+
+            if new_in:
+                idle_ticks = 0
+                cur_sleep = cfg.poll_min
+            else:
+                idle_ticks += 1
+                cur_sleep = min(cfg.poll_max, cfg.poll_min * (2 ** min(idle_ticks, 5)))
+
+            await asyncio.sleep(cur_sleep)
+    finally:
+        if refresher is not None:
+            refresher.cancel()
+        pool.shutdown(wait=False)
+        api.close()
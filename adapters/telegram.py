@@ -2,7 +2,7 @@
 import asyncio
 import os
 from collections import defaultdict
-from typing import Dict, List
+from typing import Awaitable, Callable, Dict, List, Optional
 
 from aiogram import Bot, Dispatcher, F, Router
 from aiogram.filters import Command
@@ -11,6 +11,73 @@ from aiogram.types import FSInputFile, Message
 from core.app_state import AppState
 
 
+class _Coalescer:
+    """
+    Склеивает уведомления в менеджерский чат, пришедшие в пределах `delay` секунд,
+    в одно сообщение (режем по max_len, лимит Telegram — 4096 символов).
+    Буфер ограничен max_pending: когда он полон, вызов ждёт реальной отправки,
+    и очередь уведомлений в AppState получает обратное давление.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[str], Awaitable[None]],
+        delay: float = 0.5,
+        max_len: int = 3900,
+        sep: str = "\n\n---\n\n",
+        max_pending: int = 50,
+    ):
+        self.send = send
+        self.delay = float(delay)
+        self.max_len = int(max_len)
+        self.sep = sep
+        self.max_pending = max(1, int(max_pending))
+        self._buf: List[str] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def __call__(self, text: str) -> None:
+        self._buf.append(text)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush())
+        if len(self._buf) >= self.max_pending:
+            # shield: отмена вызывающего не должна обрывать отправку остальных
+            await asyncio.shield(self._task)
+
+    async def _flush(self) -> None:
+        # одна задача шлёт всё по порядку; пока идёт отправка, новое копится в _buf
+        while self._buf:
+            await asyncio.sleep(self.delay)
+            parts, self._buf = self._buf, []
+            for chunk in self._pack(parts):
+                try:
+                    await self.send(chunk)
+                except Exception:
+                    pass
+
+    def _pack(self, parts: List[str]) -> List[str]:
+        chunks: List[str] = []
+        cur = ""
+        for p in parts:
+            # одно слишком длинное уведомление режем на куски
+            while len(p) > self.max_len:
+                if cur:
+                    chunks.append(cur)
+                    cur = ""
+                chunks.append(p[: self.max_len])
+                p = p[self.max_len:]
+            if not p:
+                continue
+            cand = f"{cur}{self.sep}{p}" if cur else p
+            if len(cand) > self.max_len:
+                chunks.append(cur)
+                cur = p
+            else:
+                cur = cand
+        if cur:
+            chunks.append(cur)
+        return chunks
+
+
 class DebouncedReply:
     def __init__(self, bot: Bot, state: AppState, delay: float = 1.2, platform: str = "tg"):
         self.bot = bot
@@ -19,6 +86,8 @@ class DebouncedReply:
         self.platform = platform
         self._buffers: Dict[int, List[str]] = defaultdict(list)
         self._tasks: Dict[int, asyncio.Task] = {}
+        self._deadlines: Dict[int, float] = {}
+        self._last_message: Dict[int, Message] = {}
 
     async def push(self, message: Message) -> None:
         if not message.text or not message.from_user:
@@ -26,19 +95,27 @@ class DebouncedReply:
 
         uid = message.from_user.id
         self._buffers[uid].append(message.text.strip())
+        self._last_message[uid] = message
 
+        # Одна задача на «пачку» сообщений: новое сообщение только сдвигает дедлайн
+        # (без cancel + create_task на каждое сообщение).
+        self._deadlines[uid] = asyncio.get_running_loop().time() + self.delay
         t = self._tasks.get(uid)
-        if t and not t.done():
-            t.cancel()
-
-        self._tasks[uid] = asyncio.create_task(self._flush(uid, message))
-
-    async def _flush(self, uid: int, message: Message) -> None:
-        try:
-            await asyncio.sleep(self.delay)
-        except asyncio.CancelledError:
-            return
-
+        if t is None or t.done():
+            self._tasks[uid] = asyncio.create_task(self._flush(uid))
+
+    async def _flush(self, uid: int) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            left = self._deadlines.get(uid, 0.0) - loop.time()
+            if left <= 0:
+                break
+            await asyncio.sleep(left)
+
+        # пачка закрыта: следующие сообщения пойдут в новую задачу
+        self._tasks.pop(uid, None)
+        self._deadlines.pop(uid, None)
+        message = self._last_message.pop(uid)
         parts = self._buffers.pop(uid, [])
         if not parts:
             return
@@ -135,7 +212,8 @@ async def run_telegram(
             print(f"[tg] notify_coro error: {e}")
             return
 
-    state.set_notifier(asyncio.get_running_loop(), notify_coro)
+    # пачку уведомлений (несколько лидов/просьб менеджера подряд) шлём одним сообщением
+    state.set_notifier(asyncio.get_running_loop(), _Coalescer(notify_coro))
     debouncer = DebouncedReply(bot=bot, state=state, delay=debounce_delay, platform="tg")
 
     @router.message(Command("start"))
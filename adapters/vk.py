@@ -4,7 +4,7 @@ import os
 import socket
 import time
 from collections import defaultdict
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Tuple
 
 import aiohttp
 
@@ -75,6 +75,9 @@ class DebouncedReply:
         self.delay = float(delay)
         self._buffers: Dict[int, List[str]] = defaultdict(list)
         self._tasks: Dict[int, asyncio.Task] = {}
+        self._deadlines: Dict[int, float] = {}
+        # user_id -> (peer_id, meta, session, token) из последнего сообщения пачки
+        self._last_ctx: Dict[int, Tuple[int, Dict[str, Any], aiohttp.ClientSession, str]] = {}
 
     async def push(
         self,
@@ -86,26 +89,27 @@ class DebouncedReply:
         token: str,
     ) -> None:
         self._buffers[user_id].append(text.strip())
+        self._last_ctx[user_id] = (peer_id, meta, session, token)
 
+        # Одна задача на «пачку» сообщений: новое сообщение только сдвигает дедлайн
+        # (без cancel + create_task на каждое сообщение).
+        self._deadlines[user_id] = asyncio.get_running_loop().time() + self.delay
         t = self._tasks.get(user_id)
-        if t and not t.done():
-            t.cancel()
+        if t is None or t.done():
+            self._tasks[user_id] = asyncio.create_task(self._flush(user_id))
 
-        self._tasks[user_id] = asyncio.create_task(self._flush(user_id, peer_id, meta, session, token))
-
-    async def _flush(
-        self,
-        user_id: int,
-        peer_id: int,
-        meta: Dict[str, Any],
-        session: aiohttp.ClientSession,
-        token: str,
-    ) -> None:
-        try:
-            await asyncio.sleep(self.delay)
-        except asyncio.CancelledError:
-            return
+    async def _flush(self, user_id: int) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            left = self._deadlines.get(user_id, 0.0) - loop.time()
+            if left <= 0:
+                break
+            await asyncio.sleep(left)
 
+        # пачка закрыта: следующие сообщения пойдут в новую задачу
+        self._tasks.pop(user_id, None)
+        self._deadlines.pop(user_id, None)
+        peer_id, meta, session, token = self._last_ctx.pop(user_id)
         parts = self._buffers.pop(user_id, [])
         if not parts:
             return
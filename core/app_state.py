@@ -1,23 +1,35 @@
 # core/app_state.py
 import asyncio
 import datetime
+import hashlib
+import json
 import os
 import re
+import sys
+import threading
 import time
+from collections import Counter, OrderedDict, deque
 from pathlib import Path
 from difflib import SequenceMatcher
-from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
 
 from core.extractor import extract_info
 from core.history import ChatHistory
 from core.intent import IntentDetector
 from core.lead_store import LeadStoreTxt, LeadStoreJsonl
-from core.memory_store import FileKVStore
+from core.memory_store import BufferedKVStore, FileKVStore, SqliteKVStore
 from core.fewshot import FewShotManager
 from core.pricing import PricingEngine
 from core.promotions import PromotionManager
 from core.response import OllamaClient, LLMTimeoutError
 
+try:
+    from rapidfuzz import fuzz as _rf_fuzz, process as _rf_process
+except ImportError:  # rapidfuzz опционален: без него fuzzy идёт через difflib.SequenceMatcher
+    _rf_fuzz = None
+    _rf_process = None
+
 DEFAULT_SYSTEM_PROMPT = """Ты — Ульяна, менеджер по натяжным потолкам.
 Общайся по-русски.
 
@@ -67,7 +79,9 @@ CITIES_EKB = [
     "Екатеринбург", "Верхняя Пышма", "Шайдурово", "Горный щит", "Березовский",
     "Прохладный", "Логиново", "Хризолитовый",
 ]
-SUPPORTED_CITIES = sorted(set(CITIES_IZH + CITIES_EKB), key=len, reverse=True)
+# неизменяемый кортеж; dict.fromkeys вместо set — порядок городов одной длины
+# (и значит CITY_RANK) не зависит от hash seed процесса
+SUPPORTED_CITIES: Tuple[str, ...] = tuple(sorted(dict.fromkeys(CITIES_IZH + CITIES_EKB), key=len, reverse=True))
 
 
 # ------------------- city normalization/fuzzy -------------------
@@ -76,29 +90,95 @@ _CASE_ENDINGS = (
     "ый", "ий", "ая", "яя", "ое", "ее", "ую", "юю", "ым", "им", "ом", "ем", "ых", "их",
     "а", "я", "у", "ю", "е", "и", "о"
 )
+# Окончания по длине (3, 2, 1): для слова проверяем не больше трёх срезов w[-n:] по хэшу
+# вместо endswith по всему списку. Порядок «длинное окончание первым» тот же, что и в списке выше.
+_ENDINGS_BY_LEN: Tuple[Tuple[int, frozenset], ...] = tuple(
+    (n, frozenset(e for e in _CASE_ENDINGS if len(e) == n)) for n in (3, 2, 1)
+)
 
 def _compress_repeats(s: str) -> str:
-    return re.sub(r"(.)\1+", r"\1", s)
-
+    # «ижжевск» -> «ижевск». Простой проход по символам: на коротких словах быстрее regex (.)\1+.
+    # Переводы строк, как и у (.) без DOTALL, не схлопываем (в словах их и не бывает).
+    out = []
+    prev = ""
+    for ch in s:
+        if ch != prev or ch == "\n":
+            out.append(ch)
+        prev = ch
+    return "".join(out)
+
+# ё→е и длинные тире→дефис одним проходом str.translate вместо цепочки replace()
+_TR_NORM = str.maketrans({"ё": "е", "Ё": "Е", "—": "-", "–": "-"})
+
+# Общие шаблоны нормализации — компилируем один раз на модуль
+_NON_LETTER_RE = re.compile(r"[^a-zа-я\-]+", re.IGNORECASE)
+_WS_RE = re.compile(r"\s+")
+
+# Чистые строковые функции: словарь пользователей маленький (города, «да», «нет», площади),
+# поэтому одинаковые слова и фразы повторяются из хода в ход — кэшируем.
+@lru_cache(maxsize=8192)
 def _stem_ru_word(w: str) -> str:
-    w = (w or "").lower().replace("ё", "е").replace("—", "-").replace("–", "-")
-    w = re.sub(r"[^a-zа-я\-]+", "", w, flags=re.IGNORECASE)
+    w = (w or "").translate(_TR_NORM).lower()
+    w = _NON_LETTER_RE.sub("", w)
     w = _compress_repeats(w)
-    for suf in _CASE_ENDINGS:
-        if w.endswith(suf) and len(w) - len(suf) >= 3:
-            w = w[:-len(suf)]
+    for n, endings in _ENDINGS_BY_LEN:
+        if len(w) - n >= 3 and w[-n:] in endings:
+            w = w[:-n]
             break
     return w
 
+@lru_cache(maxsize=2048)
 def _norm_phrase(phrase: str) -> str:
-    phrase = (phrase or "").replace("ё", "е").replace("—", "-").replace("–", "-")
-    phrase = re.sub(r"\s+", " ", phrase).strip().replace("-", " ")
+    phrase = (phrase or "").translate(_TR_NORM)
+    phrase = _WS_RE.sub(" ", phrase).strip().replace("-", " ")
     words = [w for w in phrase.split() if w]
     words = [_stem_ru_word(w) for w in words]
     words = [w for w in words if w]
     return " ".join(words).strip()
 
-NORM_CITIES: List[Tuple[str, str]] = [(c, _norm_phrase(c)) for c in SUPPORTED_CITIES]
+# Неизменяемые таблицы городов: кортежи + interned-строки (сравнение одинаковых ключей — по указателю)
+NORM_CITIES: Tuple[Tuple[str, str], ...] = tuple(
+    (sys.intern(c), sys.intern(_norm_phrase(c))) for c in SUPPORTED_CITIES
+)
+NORM_CITY_KEYS: Tuple[str, ...] = tuple(n for _, n in NORM_CITIES)
+# нормализованная форма -> город (при совпадении форм — первый по порядку NORM_CITIES)
+NORM_CITY_BY_KEY: Dict[str, str] = {n: c for c, n in reversed(NORM_CITIES)}
+# составные нормализованные формы по числу слов: «мал пург» -> {2: {...}}
+NORM_MULTI_BY_LEN: Dict[int, Dict[str, str]] = {}
+for _city, _norm in reversed(NORM_CITIES):
+    if " " in _norm:
+        NORM_MULTI_BY_LEN.setdefault(_norm.count(" ") + 1, {})[_norm] = _city
+del _city, _norm
+
+# lower(город) -> позиция в SUPPORTED_CITIES (меньше = длиннее = приоритетнее)
+CITY_RANK: Dict[str, int] = {c.lower(): i for i, c in enumerate(SUPPORTED_CITIES)}
+# Exact-поиск: однословные города — пересечением с множеством слов текста (одно слово = \w+,
+# ровно как границы \b), составные («Малая Пурга», «Якшур-Бодья») — через find с проверкой границ.
+_WORD_RE = re.compile(r"\w+")
+CITIES_LOWER_SINGLE = frozenset(c for c in CITY_RANK if _WORD_RE.fullmatch(c))
+CITIES_LOWER_MULTI: Tuple[str, ...] = tuple(c for c in CITY_RANK if c not in CITIES_LOWER_SINGLE)
+
+
+def _exact_city_rank(t: str) -> Optional[int]:
+    """Лучший (самый длинный) город, встречающийся в тексте целым словом/фразой."""
+    tl = t.lower()
+    best: Optional[int] = None
+    for w in CITIES_LOWER_SINGLE.intersection(_WORD_RE.findall(tl)):
+        r = CITY_RANK[w]
+        if best is None or r < best:
+            best = r
+    for c in CITIES_LOWER_MULTI:
+        r = CITY_RANK[c]
+        if best is not None and r > best:
+            continue
+        i = tl.find(c)
+        while i >= 0:
+            j = i + len(c)
+            if (i == 0 or not _WORD_RE.match(tl[i - 1])) and (j == len(tl) or not _WORD_RE.match(tl[j])):
+                best = r
+                break
+            i = tl.find(c, i + 1)
+    return best
 
 # Short aliases users often type.
 # Important: we normalize latin look-alikes too (EKB, etc.).
@@ -127,66 +207,150 @@ _LATIN_LOOKALIKES = str.maketrans({
     "t": "т",
     "y": "у",
     "h": "н",
+    # ё→е тем же проходом translate, без отдельного replace()
+    "ё": "е",
 })
 
 
 def _norm_city_token(s: str) -> str:
-    s = (s or "").strip().lower().replace("ё", "е")
-    s = s.translate(_LATIN_LOOKALIKES)
-    s = re.sub(r"[^a-zа-я\-]+", "", s, flags=re.IGNORECASE)
+    s = (s or "").strip().lower().translate(_LATIN_LOOKALIKES)
+    s = _NON_LETTER_RE.sub("", s)
     return s
 
+# Порог fuzzy и бонус за подстроку (см. extract_city)
+_FUZZY_MIN_SCORE = 0.86
+_FUZZY_SUBSTR_BONUS = 0.08
+_FUZZY_EPS = 1e-9
+
+def _fuzzy_reachable(la: int, ncity: str, norm_text: str) -> bool:
+    # ratio() = 2*M/(la+lb) и M <= min(la, lb): если даже верхняя граница (плюс бонус)
+    # не дотягивает до порога — SequenceMatcher для этого города можно не запускать.
+    lb = len(ncity)
+    if not lb:
+        return False
+    upper = 2.0 * min(la, lb) / (la + lb)
+    if ncity in norm_text:
+        upper += _FUZZY_SUBSTR_BONUS
+    return upper + _FUZZY_EPS >= _FUZZY_MIN_SCORE
+
+# Состав букв каждого города: совпавших символов у SequenceMatcher не больше, чем общих букв
+# (пересечение мультимножеств), это граница точнее, чем по длинам.
+NORM_CITY_COUNTS: Tuple[Counter, ...] = tuple(Counter(n) for n in NORM_CITY_KEYS)
+
+def _fuzzy_chars_reachable(text_counts: Counter, la: int, i: int, norm_text: str) -> bool:
+    ncity = NORM_CITY_KEYS[i]
+    common = sum((text_counts & NORM_CITY_COUNTS[i]).values())
+    upper = 2.0 * common / (la + len(ncity))
+    if ncity in norm_text:
+        upper += _FUZZY_SUBSTR_BONUS
+    return upper + _FUZZY_EPS >= _FUZZY_MIN_SCORE
+
+def _fuzzy_city_scores(norm_text: str):
+    """(индекс в NORM_CITIES, похожесть 0..1) в порядке NORM_CITIES."""
+    if _rf_process is not None:
+        # rapidfuzz — только C-префильтр: Indel-ratio (через LCS) >= SequenceMatcher.ratio(),
+        # т.е. это верхняя граница. Бонус за подстроку не больше 0.08, поэтому кандидаты
+        # ниже 0.78 порог 0.86 всё равно не пройдут. Выжившие пересчитываем SequenceMatcher'ом,
+        # чтобы порог видел те же числа, что и без rapidfuzz.
+        hits = _rf_process.extract(
+            norm_text, NORM_CITY_KEYS, scorer=_rf_fuzz.ratio, score_cutoff=77.9, limit=None
+        )
+        return [
+            (idx, SequenceMatcher(None, norm_text, NORM_CITY_KEYS[idx]).ratio())
+            for idx in sorted(idx for _, _, idx in hits)
+        ]
+    la = len(norm_text)
+    text_counts = Counter(norm_text)
+    return (
+        (i, SequenceMatcher(None, norm_text, ncity).ratio())
+        for i, ncity in enumerate(NORM_CITY_KEYS)
+        if _fuzzy_reachable(la, ncity, norm_text) and _fuzzy_chars_reachable(text_counts, la, i, norm_text)
+    )
+
+
+_FUZZY_MAX_TEXT_LEN = int(
+    max(len(n) for n in NORM_CITY_KEYS) * (2.0 - (_FUZZY_MIN_SCORE - _FUZZY_SUBSTR_BONUS))
+    / (_FUZZY_MIN_SCORE - _FUZZY_SUBSTR_BONUS)
+) + 1
+
+_CITY_TOK2_RE = re.compile(r"[A-Za-zА-Яа-яЁё\-]{2,}")
+_CITY_TOK3_RE = re.compile(r"[A-Za-zА-Яа-яЁё\-]{3,}")
+# хотя бы две буквы где угодно: короче не бывает ни алиасов («иж», «ekb»), ни городов
+_TWO_LETTERS_RE = re.compile(r"[A-Za-zА-Яа-яЁё].*?[A-Za-zА-Яа-яЁё]", re.DOTALL)
+
+
 def extract_city(text: str) -> Optional[str]:
     t = (text or "").strip()
     if not t:
         return None
+    # «+», «5», телефон, смайлы — ни один из проходов ниже ничего не найдёт
+    if not _TWO_LETTERS_RE.search(t):
+        return None
 
     # Alias hit (including inside phrases: "я из ижа", "в екб")
     if CITY_ALIASES:
         nt = _norm_city_token(t)
         if nt in CITY_ALIASES:
             return CITY_ALIASES[nt]
-        for tok in re.findall(r"[A-Za-zА-Яа-яЁё\-]{2,}", t):
+        for tok in _CITY_TOK2_RE.findall(t):
             nt = _norm_city_token(tok)
             if nt in CITY_ALIASES:
                 return CITY_ALIASES[nt]
 
     # Token-level stem match ("из ижевска" -> token "ижевска" -> stem "ижевск")
     try:
-        for tok in re.findall(r"[A-Za-zА-Яа-яЁё\-]{3,}", t):
+        for tok in _CITY_TOK3_RE.findall(t):
             st = _stem_ru_word(tok)
             if not st:
                 continue
-            for city, ncity in NORM_CITIES:
-                if st == ncity:
-                    return city
+            city = NORM_CITY_BY_KEY.get(st)
+            if city:
+                return city
     except Exception:
         pass
 
-    # быстрый exact (с учётом регистра)
-    for city in SUPPORTED_CITIES:
-        if re.search(rf"\b{re.escape(city)}\b", t, flags=re.IGNORECASE):
-            return city
+    # быстрый exact: при нескольких совпадениях побеждает более длинное название
+    best = _exact_city_rank(t)
+    if best is not None:
+        return SUPPORTED_CITIES[best]
 
-    # fuzzy
     norm_text = _norm_phrase(t)
     if not norm_text:
         return None
 
+    # exact по нормализованным словам для составных названий («в старые кены переехали»):
+    # работает и на длинных сообщениях, где fuzzy ниже не запускается
+    if NORM_MULTI_BY_LEN:
+        words = norm_text.split()
+        best = None
+        for n, table in NORM_MULTI_BY_LEN.items():
+            for i in range(len(words) - n + 1):
+                city = table.get(" ".join(words[i:i + n]))
+                if city and (best is None or CITY_RANK[city.lower()] < CITY_RANK[best.lower()]):
+                    best = city
+        if best:
+            return best
+
+    # fuzzy
+    # Длинный текст (обычное сообщение, а не название города) не может набрать порог ни с одним городом:
+    # даже с бонусом нужно 2*lb/(la+lb) >= 0.78. Тогда весь fuzzy-проход пропускаем.
+    if len(norm_text) > _FUZZY_MAX_TEXT_LEN:
+        return None
+
     best_city = None
     best_score = 0.0
-    for city, ncity in NORM_CITIES:
+    for i, score in _fuzzy_city_scores(norm_text):
+        city, ncity = NORM_CITIES[i]
         if not ncity:
             continue
-        score = SequenceMatcher(None, norm_text, ncity).ratio()
         # небольшой бонус, если city-строка как подстрока
         if ncity and ncity in norm_text:
-            score += 0.08
+            score += _FUZZY_SUBSTR_BONUS
         if score > best_score:
             best_score = score
             best_city = city
 
-    if best_city and best_score >= 0.86:
+    if best_city and best_score >= _FUZZY_MIN_SCORE:
         return best_city
     return None
 
@@ -194,6 +358,15 @@ def extract_city(text: str) -> Optional[str]:
 # мы НЕ должны переспрашивать город, а должны сразу сказать "не работаем"
 CITY_CANDIDATE_RE = re.compile(r"\b(?:город|г\.)\s*([A-Za-zА-Яа-яЁё\-\s]{3,40})", re.IGNORECASE)
 
+_CAND_JUNK_RE = re.compile(r"[^\w\s\-]+", re.IGNORECASE)
+_CAND_GREETING_RE = re.compile(
+    r"(привет|приветствую|здравствуйте|здравствуй|здраствуйте|здравсвуйте|здрастуйте|здрасьте|"
+    r"добрый день|добрый вечер|доброе утро|спасибо|ок|окей|ага)"
+)
+_CAND_LOW_WORD_RE = re.compile(r"[a-zа-я\-]{3,30}")
+_CAND_GREET_PREFIX_RE = re.compile(r"^(здрав|здра|прив|доб|спас)")
+_CAND_WORD_RE = re.compile(r"[A-Za-zА-Яа-яЁё\-]{3,30}")
+
 def extract_city_candidate(text: str) -> Optional[str]:
     t = (text or "").strip()
     if not t:
@@ -201,31 +374,27 @@ def extract_city_candidate(text: str) -> Optional[str]:
 
     # Нормализуем для проверок
     low = t.lower().replace("ё", "е").strip()
-    low = re.sub(r"[^\w\s\-]+", "", low, flags=re.IGNORECASE)
-    low = re.sub(r"\s+", " ", low).strip()
+    low = _CAND_JUNK_RE.sub("", low)
+    low = _WS_RE.sub(" ", low).strip()
 
     # 1) Отсекаем приветствия/мусор (включая частые опечатки)
-    if re.fullmatch(
-        r"(привет|приветствую|здравствуйте|здравствуй|здраствуйте|здравсвуйте|здрастуйте|здрасьте|"
-        r"добрый день|добрый вечер|доброе утро|спасибо|ок|окей|ага)",
-        low,
-    ):
+    if _CAND_GREETING_RE.fullmatch(low):
         return None
 
     # если одно слово и явно похоже на приветствие (даже с опечаткой)
-    if re.fullmatch(r"[a-zа-я\-]{3,30}", low) and re.match(r"^(здрав|здра|прив|доб|спас)", low):
+    if _CAND_LOW_WORD_RE.fullmatch(low) and _CAND_GREET_PREFIX_RE.match(low):
         return None
 
     # 2) Явная форма: "город X" / "г. X"
     m = CITY_CANDIDATE_RE.search(t)
     if m:
         cand = m.group(1).strip(" ,.!?:;()[]{}\"'").strip()
-        cand = re.sub(r"\s+", " ", cand)
+        cand = _WS_RE.sub(" ", cand)
         if 2 <= len(cand) <= 40:
             return cand
 
     # 3) Если сообщение — просто одно слово (часто так пишут город)
-    if re.fullmatch(r"[A-Za-zА-Яа-яЁё\-]{3,30}", t):
+    if _CAND_WORD_RE.fullmatch(t):
         return t
 
     return None
@@ -261,6 +430,7 @@ def _remember_estimate(mem: Dict[str, Any], sig: str) -> None:
     mem["_last_estimate_sig"] = sig
     mem["_last_estimate_ts"] = time.time()
 
+@lru_cache(maxsize=4)
 def build_materials_vs_turnkey(first: bool) -> str:
     return (
         f"{t_hello(first)}Это ориентир *под ключ* ✅\n"
@@ -297,20 +467,23 @@ def detect_handoff_request(text: str) -> bool:
 
 AFFIRM_RE = re.compile(r"\b(да|ок|хорошо|давайте|согласен|согласна|подтверждаю|записывайте)\b", re.IGNORECASE)
 NEG_RE = re.compile(r"\b(нет|не надо|не нужно|отмена|передумал|передумала)\b", re.IGNORECASE)
-def detect_affirm(text: str) -> bool:
-    low = (text or "").lower()
-    return bool(AFFIRM_RE.search(low)) and not bool(re.search(r"\bне\b", low))
+NOT_WORD_RE = re.compile(r"\bне\b")
+def detect_affirm(text: str, low: Optional[str] = None) -> bool:
+    if low is None:
+        low = (text or "").lower()
+    return bool(AFFIRM_RE.search(low)) and not bool(NOT_WORD_RE.search(low))
 def detect_neg(text: str) -> bool:
     return bool(NEG_RE.search(text or ""))
 
-def detect_price_question(text: str) -> bool:
-    low = (text or "").lower()
-    triggers = [
-        "сколько стоит", "стоимость", "цена", "по чем", "почем",
-        "просчитать", "рассчитать", "посчитать", "посчитайте",
-        "примерно", "ориентир", "сколько выйдет", "предварительно",
-    ]
-    return any(t in low for t in triggers)
+PRICE_TRIGGERS = (
+    "сколько стоит", "стоимость", "цена", "по чем", "почем",
+    "просчитать", "рассчитать", "посчитать", "посчитайте",
+    "примерно", "ориентир", "сколько выйдет", "предварительно",
+)
+# подстроки (как `in`), одним проходом; проверяется по lower()
+PRICE_Q_RE = re.compile("|".join(re.escape(t) for t in PRICE_TRIGGERS))
+def detect_price_question(text: str, low: Optional[str] = None) -> bool:
+    return bool(PRICE_Q_RE.search((text or "").lower() if low is None else low))
 
 MEASURE_BOOK_RE = re.compile(r"\b(запиш|замер|приех|выех|когда\s+можете|когда\s+приедете)\b", re.IGNORECASE)
 def detect_measurement_booking_intent(text: str) -> bool:
@@ -347,17 +520,93 @@ PHONE_REFUSAL_RE = re.compile(r"\b(не\s+дам\s+телефон|без\s+те
 def detect_phone_refusal(text: str) -> bool:
     return bool(PHONE_REFUSAL_RE.search(text or ""))
 
-def extract_phone(text: str) -> Optional[str]:
-    m = PHONE_RE.search(text or "")
-    if not m:
-        return None
-    digits = re.sub(r"\D", "", m.group(0))
+
+# ------------------- all intents at once -------------------
+# Битовая маска намерений сообщения: generate_reply считает её один раз и дальше проверяет биты,
+# вместо повторного прогона одних и тех же regex по user_text в каждой ветке.
+# Одну общую альтернацию не делаем: намерения пересекаются («не надо замер» — и отказ, и «нет»),
+# а finditer вернул бы только одно из перекрывающихся совпадений.
+INTENT_DISCOUNT = 1 << 0
+INTENT_MEASURE_DECLINE = 1 << 1
+INTENT_CALC_ONLY = 1 << 2
+INTENT_AFFIRM = 1 << 3
+INTENT_NEG = 1 << 4
+INTENT_PRICE = 1 << 5
+INTENT_MEASURE_BOOK = 1 << 6
+INTENT_MEASURE_INFO = 1 << 7
+INTENT_PHONE_REFUSAL = 1 << 8
+INTENT_SOUNDPROOF = 1 << 9
+INTENT_OUT_OF_CITY = 1 << 10
+
+# user_text для принудительного пересчёта на Авито (уже в нижнем регистре и без «ё»)
+AUTO_ESTIMATE_MARKER = " (рассчитай стоимость)"
+
+def detect_intents(text: str, low: Optional[str] = None) -> int:
+    """То же, что соответствующие detect_*(), но каждый regex — один раз. low — готовый text.lower()."""
+    t = text or ""
+    if low is None:
+        low = t.lower()
+    f = 0
+    if DISCOUNT_RE.search(t):
+        f |= INTENT_DISCOUNT
+    if MEASURE_DECLINE_RE.search(t):
+        f |= INTENT_MEASURE_DECLINE
+    else:
+        if MEASURE_BOOK_RE.search(t):
+            f |= INTENT_MEASURE_BOOK
+        if MEASURE_INFO_RE.search(t):
+            f |= INTENT_MEASURE_INFO
+    if CALC_ONLY_RE.search(t):
+        f |= INTENT_CALC_ONLY
+    if AFFIRM_RE.search(low) and not NOT_WORD_RE.search(low):
+        f |= INTENT_AFFIRM
+    if NEG_RE.search(t):
+        f |= INTENT_NEG
+    if PRICE_Q_RE.search(low):
+        f |= INTENT_PRICE
+    if PHONE_REFUSAL_RE.search(t):
+        f |= INTENT_PHONE_REFUSAL
+    if SOUNDPROOF_RE.search(t):
+        f |= INTENT_SOUNDPROOF
+    if OUT_OF_CITY_RE.search(t):
+        f |= INTENT_OUT_OF_CITY
+    return f
+
+_NON_DIGIT_RE = re.compile(r"\D")
+
+def _normalize_phone(raw: str) -> Optional[str]:
+    digits = _NON_DIGIT_RE.sub("", raw)
     if len(digits) == 11 and digits.startswith("8"):
         digits = "7" + digits[1:]
     if len(digits) == 11 and digits.startswith("7"):
         return "+" + digits
     return None
 
+def extract_phone(text: str) -> Optional[str]:
+    m = PHONE_RE.search(text or "")
+    if not m:
+        return None
+    return _normalize_phone(m.group(0))
+
+def split_phone_and_rest(text: str) -> Tuple[Optional[str], str]:
+    """
+    Один проход PHONE_RE: первый телефон (как extract_phone) и текст, где все телефоны
+    заменены пробелом (как PHONE_ANY_RE.sub(" ", text)).
+    """
+    text = text or ""
+    phone: Optional[str] = None
+    parts: List[str] = []
+    pos = 0
+    for m in PHONE_RE.finditer(text):
+        if not parts:
+            phone = _normalize_phone(m.group(0))
+        parts.append(text[pos:m.start()])
+        pos = m.end()
+    if not parts:
+        return None, text
+    parts.append(text[pos:])
+    return phone, " ".join(parts)
+
 
 # ------------------- date/time/address -------------------
 TIME_HHMM_RE = re.compile(r"\b([01]?\d|2[0-3])[:\.][0-5]\d\b")
@@ -368,18 +617,31 @@ DATE_WORD_RE = re.compile(r"\b(\d{1,2})\s*(января|февраля|март
 ADDRESS_HINT_RE = re.compile(r"\b(ул\.|улица|проспект|пр-т|дом|д\.|кв\.|квартира|корпус|строение)\b", re.IGNORECASE)
 
 AREA_HINT_RE = re.compile(r"\b(м2|м²|м\^2|кв\.?\s*м|кв\.?\b|квм\b|квадрат)\b", re.IGNORECASE)
-
-def extract_visit_time(text: str) -> Optional[str]:
-    low = (text or "").lower()
-    m = TIME_HHMM_RE.search(text or "")
-    if m:
-        return m.group(0).replace(".", ":")
-    m = TIME_PLAIN_H_RE.match((text or "").strip())
-    if m:
-        hh = int(m.group(1))
-        if hh <= 7 and ("утра" not in low) and ("ноч" not in low):
-            hh += 12
-        return f"{hh:02d}:00"
+AREA_NUM_RE = re.compile(r"\b(\d{1,3})\b")
+
+# Почти все regex полей (телефон, дата, время, адрес) требуют цифру: проверяем её один раз
+# (_extract_fields передаёт has_digit), и сообщения без цифр обходятся без этих regex.
+DIGIT_RE = re.compile(r"\d")
+CYR_RE = re.compile(r"[А-Яа-яЁё]")
+_CYR3_RE = re.compile(r"[А-Яа-яЁё]{3,}")
+_AFTER_BEFORE_RE = re.compile(r"\b(после|до)\b")
+_DAYPART_RE = re.compile(r"\b(обед|утром|вечером|днем|дн[её]м)\b")
+
+def extract_visit_time(text: str, has_digit: Optional[bool] = None, low: Optional[str] = None) -> Optional[str]:
+    if low is None:
+        low = (text or "").lower()
+    if has_digit is None:
+        has_digit = DIGIT_RE.search(text or "") is not None
+    if has_digit:
+        m = TIME_HHMM_RE.search(text or "")
+        if m:
+            return m.group(0).replace(".", ":")
+        m = TIME_PLAIN_H_RE.match((text or "").strip())
+        if m:
+            hh = int(m.group(1))
+            if hh <= 7 and ("утра" not in low) and ("ноч" not in low):
+                hh += 12
+            return f"{hh:02d}:00"
     if "обед" in low:
         return "обед"
     if "утром" in low:
@@ -390,12 +652,17 @@ def extract_visit_time(text: str) -> Optional[str]:
         return "вечером"
     return None
 
-def extract_visit_date(text: str) -> Optional[str]:
-    low = (text or "").lower()
+def extract_visit_date(text: str, has_digit: Optional[bool] = None, low: Optional[str] = None) -> Optional[str]:
+    if low is None:
+        low = (text or "").lower()
     if "сегодня" in low:
         return "сегодня"
     if "завтра" in low:
         return "завтра"
+    if has_digit is None:
+        has_digit = DIGIT_RE.search(text or "") is not None
+    if not has_digit:
+        return None
     m = DATE_NUM_RE.search(text or "")
     if m:
         dd, mm, yy = m.group(1), m.group(2), m.group(3)
@@ -417,26 +684,33 @@ def resolve_relative_date(vdate: str) -> str:
         return (today + datetime.timedelta(days=1)).strftime("%d.%m.%Y")
     return vdate
 
-def extract_address(text: str) -> Optional[str]:
+def extract_address(text: str, has_digit: Optional[bool] = None, low: Optional[str] = None) -> Optional[str]:
     t = (text or "").strip()
     if not t:
         return None
-    low = t.lower()
+    # оба «адресных» исхода ниже требуют цифру и кириллицу (подсказки адреса — русские слова):
+    # без них дальше проверять нечего, а это большинство сообщений
+    if has_digit is None:
+        has_digit = DIGIT_RE.search(t) is not None
+    if not has_digit or not CYR_RE.search(t):
+        return None
+    if low is None:
+        low = t.lower()
     # если это похоже на дату/время/площадь — не адрес
     if TIME_HHMM_RE.search(t) or DATE_NUM_RE.search(t) or DATE_WORD_RE.search(low):
         return None
     if AREA_HINT_RE.search(t):
         return None
     # «после 2», «до обеда», «после обеда» и т.п. — это про время, не про адрес
-    if re.search(r"\b(после|до)\b", low) and re.search(r"\d", low):
+    if _AFTER_BEFORE_RE.search(low):
         return None
-    if re.search(r"\b(обед|утром|вечером|днем|дн[её]м)\b", low):
+    if _DAYPART_RE.search(low):
         return None
     # если есть подсказки адреса — берём
-    if ADDRESS_HINT_RE.search(t) and re.search(r"\d", t):
+    if ADDRESS_HINT_RE.search(t):
         return t
     # или если просто "ворошилова 4" (но не "после 2")
-    if re.search(r"[А-Яа-яЁё]{3,}", t) and re.search(r"\d", t) and len(t) <= 80:
+    if len(t) <= 80 and _CYR3_RE.search(t):
         return t
     return None
 
@@ -452,9 +726,24 @@ def detect_greeting(text: str) -> bool:
 def detect_greeting_request(text: str) -> bool:
     return bool(GREET_REQUEST_RE.search(text or ""))
 
-BAD_WAIT_RE = re.compile(r"(?i)\b(жд[её]м\s+вас|приходите|ожидаем\s+вас)\b")
-BAD_I_RE = re.compile(r"(?i)\bя\s+(приеду|выех\w*|проведу\s+замер|замерю)\b")
-BAD_CALL_RE = re.compile(r"(?i)\b(позвоню|позвоним|созвон|позвоните|звоните|наберите)\b[^\n]*")
+# «ждём вас» / «я приеду» / «позвоню…» одной альтернацией: один проход sub() вместо трёх
+SANITIZE_RE = re.compile(
+    r"(?i)(?P<wait>\b(?:жд[её]м\s+вас|приходите|ожидаем\s+вас)\b)"
+    r"|(?P<i>\bя\s+(?:приеду|выех\w*|проведу\s+замер|замерю)\b)"
+    r"|(?P<call>\b(?:позвоню|позвоним|созвон|позвоните|звоните|наберите)\b[^\n]*)"
+)
+SPACES_RE = re.compile(r"[ \t]{2,}|\n{3,}")
+# каждая ветка SANITIZE_RE содержит одну из этих подстрок: нет ни одной — чистый ответ, sub() не нужен
+_SANITIZE_HINTS = (
+    "жд", "приходите", "ожидаем", "приеду", "выех", "проведу", "замерю",
+    "позвон", "созвон", "звоните", "наберите",
+)
+
+def _sanitize_repl(m: "re.Match[str]") -> str:
+    return "" if m.lastgroup == "call" else "мастер приедет"
+
+def _spaces_repl(m: "re.Match[str]") -> str:
+    return "\n\n" if m.group(0)[0] == "\n" else " "
 
 def sanitize_answer(answer: str, allow_greet: bool, allow_phone_echo: bool = False) -> str:
     if not answer:
@@ -462,14 +751,13 @@ def sanitize_answer(answer: str, allow_greet: bool, allow_phone_echo: bool = Fal
     s = answer.strip()
     if not allow_greet:
         s = GREET_RE.sub("", s, count=1).strip()
-    s = BAD_WAIT_RE.sub("мастер приедет", s)
-    s = BAD_I_RE.sub("мастер приедет", s)
-    s = BAD_CALL_RE.sub("", s).strip()
-    if not allow_phone_echo:
+    sl = s.lower()
+    if any(h in sl for h in _SANITIZE_HINTS):
+        s = SANITIZE_RE.sub(_sanitize_repl, s)
+    # телефон всегда начинается с «8» или «+7»
+    if not allow_phone_echo and ("8" in s or "+7" in s):
         s = PHONE_ANY_RE.sub("", s)
-    s = re.sub(r"[ \t]{2,}", " ", s)
-    s = re.sub(r"\n{3,}", "\n\n", s).strip()
-    return s
+    return SPACES_RE.sub(_spaces_repl, s).strip()
 
 
 # ------------------- text builders (паттерны как в ТГ) -------------------
@@ -479,9 +767,13 @@ PROMO_DISCOUNTS_TEXT = (
     "Скидка на освещение до 50%.\n"
 )
 
+# Шаблоны, зависящие только от first, — это всего две строки на функцию:
+# собираем их один раз (lru_cache), а не склеиваем заново на каждый ответ.
+# Шаблоны от (first, city) кэшируем так же: городов — пара десятков.
 def t_hello(first: bool) -> str:
     return "Здравствуйте 😊 " if first else ""
 
+@lru_cache(maxsize=4)
 def build_welcome(first: bool) -> str:
     return (
         f"{t_hello(first)}Будем рады помочь 😊\n"
@@ -489,10 +781,12 @@ def build_welcome(first: bool) -> str:
         "Замер бесплатный — мастер приедет с каталогами и образцами."
     )
 
+@lru_cache(maxsize=4)
 def build_need_city(first: bool) -> str:
     return f"{t_hello(first)}Подскажите, пожалуйста, в каком вы городе? 🙂"
 
 
+@lru_cache(maxsize=4)
 def build_out_of_city_need_city(first: bool) -> str:
     return (
         f"{t_hello(first)}Подскажите, пожалуйста, в каком городе вы находитесь и куда нужен выезд (район/посёлок)?\n"
@@ -500,6 +794,7 @@ def build_out_of_city_need_city(first: bool) -> str:
     )
 
 
+@lru_cache(maxsize=128)
 def build_out_of_city_answer(first: bool, city: str) -> str:
     return (
         f"{t_hello(first)}В {city} и ближайшие районы выезжаем ✅\n"
@@ -516,11 +811,13 @@ SOUNDPROOF_INFO_TEXT = (
 )
 
 
+@lru_cache(maxsize=4)
 def build_soundproofing_need_city(first: bool) -> str:
     return f"{t_hello(first)}Подскажите, пожалуйста, в каком вы городе? 🙂" \
            " (для расчёта шумо/звукоизоляции)"
 
 
+@lru_cache(maxsize=128)
 def build_soundproofing_need_area(first: bool, city: str) -> str:
     return (
         f"{t_hello(first)}{city} — поняла.\n"
@@ -539,6 +836,7 @@ def build_soundproofing_estimate(first: bool, city: str, area_m2: float) -> str:
         "Если хотите — запишу на бесплатный замер: мастер приедет и подберёт решение под ваш объект."
     )
 
+@lru_cache(maxsize=128)
 def build_soundproofing_info(first: bool, city: Optional[str]) -> str:
     city_line = "" if not city else f"В {city} можем сделать. "
     return (
@@ -554,12 +852,14 @@ def build_city_not_supported(first: bool, city_candidate: str) -> str:
         "Если объект в этих городах — напишите город и площадь (м²), сориентирую по стоимости."
     )
 
+@lru_cache(maxsize=128)
 def build_need_area(first: bool, city: str) -> str:
     return (
         f"{t_hello(first)}{city} — поняла.\n"
         "Чтобы назвать ориентир по стоимости, подскажите площадь (м²). Можно примерно 🙂"
     )
 
+@lru_cache(maxsize=128)
 def build_discounts_message(first: bool, city: Optional[str]) -> str:
     city_line = f"В {city} работаем.\n" if city else ""
     return (
@@ -583,6 +883,7 @@ def build_estimate(min_price: int, city: str, area_m2: float, ask_measure: bool)
         f"{tail}"
     )
 
+@lru_cache(maxsize=128)
 def build_measure_info(first: bool, city: str) -> str:
     return (
         f"{t_hello(first)}В {city} выезжаем.\n"
@@ -590,6 +891,7 @@ def build_measure_info(first: bool, city: str) -> str:
         "Если хотите — запишу на удобные дату и время."
     )
 
+@lru_cache(maxsize=4)
 def build_measure_intro(first: bool) -> str:
     return (
         f"{t_hello(first)}Отлично, оформим бесплатный замер ✅\n"
@@ -615,7 +917,7 @@ def _looks_like_polite_close(text: str) -> bool:
     # если в сообщении есть вопрос/цифры/ключевые слова по цене — это не закрытие
     if "?" in t:
         return False
-    if re.search(r"\d", t):
+    if DIGIT_RE.search(t):
         return False
     low = t.lower()
     if detect_price_question(low) or detect_measurement_booking_intent(low) or detect_discount_mention(low):
@@ -651,9 +953,39 @@ def build_closing(mem: Dict[str, Any], first: bool) -> str:
 
 
 # ------------------- AppState -------------------
+PLATFORM_LABELS = {
+    "avito": "Авито",
+    "tg": "TG",
+    "telegram": "TG",
+    "vk": "VK",
+    "whatsapp": "WA",
+}
+
+
+def _platform_label(p: str) -> str:
+    p = (p or "").lower()
+    return PLATFORM_LABELS.get(p, p or "-")
+
+
 EmailSender = Callable[[str, str, str], Awaitable[bool]]
 
 
+def _approx_tokens(s: str) -> int:
+    # грубо, но достаточно для бюджета: в русском тексте ~3 символа на токен
+    return len(s) // 3
+
+
+# Шаблоны из generate_reply — компилируем один раз на модуль, а не на каждый ход
+_GREET_TOPIC_RE = re.compile(r"\b(потолк|натяж|шумо|звуко|изоляц|цена|стоим|сколько)\b", re.IGNORECASE)
+_ANGLES_RE = re.compile(r"\b(\d{1,2})\s*(угл\w*)\b")
+_NOT_FLOATING_RE = re.compile(r"\bне\s+парящ")
+_FLOATING_RE = re.compile(r"\bпарящ")
+_AREA_WORD_RE = re.compile(r"\bплощад", re.IGNORECASE)
+_AREA_COUNT_NOUN_RE = re.compile(r"\b(потолк|комнат|уровн|помещен)\b", re.IGNORECASE)
+_CEILING_RE = re.compile(r"\b(потолк|натяж)\w*\b", re.IGNORECASE)
+_SPEC_UPDATE_RE = re.compile(r"\b(угл|парящ|плинтус|подсвет)\w*\b")
+
+
 class AppState:
     """
     Единое ядро: память + история + лиды + LLM.
@@ -675,6 +1007,25 @@ class AppState:
         self.ollama_timeout = int(ollama_timeout)
         self.ollama = OllamaClient(model=model, timeout=self.ollama_timeout)
 
+        # Кэш ответов LLM: точное совпадение всего списка messages -> ответ (TTL + LRU).
+        # LLM_CACHE_TTL=0 — выключить.
+        try:
+            self.llm_cache_ttl = float(os.getenv("LLM_CACHE_TTL", "600") or "600")
+        except Exception:
+            self.llm_cache_ttl = 600.0
+        try:
+            self.llm_cache_max = int(os.getenv("LLM_CACHE_SIZE", "4096") or "4096")
+        except Exception:
+            self.llm_cache_max = 4096
+        self._llm_cache: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+        # потолок (в приблизительных токенах) для блока фактов + последних реплик в промпте
+        try:
+            self.context_token_budget = int(os.getenv("LLM_CONTEXT_TOKENS", "800") or "800")
+        except Exception:
+            self.context_token_budget = 800
+        self._llm_cache_lock = threading.Lock()
+
         # Позволяем управлять поведением через .env (в проекте уже есть SYSTEM_PROMPT/MAX_HISTORY).
         self.system_prompt = (os.getenv("SYSTEM_PROMPT") or DEFAULT_SYSTEM_PROMPT).strip()
         try:
@@ -687,7 +1038,18 @@ class AppState:
         self.intents = IntentDetector()
         self.dialog_log_dir = _abs(os.getenv("DIALOG_LOG_DIR", "data/dialog_logs"))
         os.makedirs(self.dialog_log_dir, exist_ok=True)
-        self.mem_store = FileKVStore(dir_path=_abs(os.getenv("MEMORY_DIR", "data/memory")))
+        # MEMORY_BACKEND=sqlite — вся память в одной SQLite-базе (WAL) вместо файла на пользователя
+        if (os.getenv("MEMORY_BACKEND", "file") or "file").strip().lower() == "sqlite":
+            self.mem_store = SqliteKVStore(_abs(os.getenv("MEMORY_DB_PATH", "data/memory.sqlite3")))
+        else:
+            self.mem_store = FileKVStore(dir_path=_abs(os.getenv("MEMORY_DIR", "data/memory")))
+        # MEMORY_FLUSH_SEC > 0 — память пишется на диск пачками раз в N секунд, 0 — сразу
+        try:
+            mem_flush_sec = float(os.getenv("MEMORY_FLUSH_SEC", "1.0") or "1.0")
+        except Exception:
+            mem_flush_sec = 1.0
+        if mem_flush_sec > 0:
+            self.mem_store = BufferedKVStore(self.mem_store, flush_interval=mem_flush_sec)
         self.leads = LeadStoreTxt(
             path=_abs(os.getenv("LEADS_PATH", "data/leads.txt")),
             leads_dir=_abs(os.getenv("LEADS_DIR", "data/leads")),
@@ -705,25 +1067,151 @@ class AppState:
 
         self.histories: Dict[str, ChatHistory] = {}
 
+        # user_text -> сырые результаты extract_*; общий для всех диалогов: «да», «ок», «Ижевск»,
+        # «+» и повторы Авито у разных клиентов не гоняют regex/fuzzy заново
+        self._extract_cache: "OrderedDict[str, Dict[str, Optional[str]]]" = OrderedDict()
+        self._extract_cache_max = 1024
+        self._extract_lock = threading.Lock()
+
         self._loop = None
         self._notify_coro = None
+        self._notify_q: Optional[asyncio.Queue] = None
 
         self._email_loop = None
         self._email_sender: Optional[EmailSender] = None
+        self._email_q: Optional[asyncio.Queue] = None
+
+        # долгоживущие задачи-разборщики очередей (держим ссылки, чтобы их не собрал GC)
+        self._sink_workers: List[asyncio.Task] = []
+        # запасной ограниченный буфер на очередь: сюда уходят события, пока очередь полна
+        self._sink_overflow: Dict[asyncio.Queue, Deque[Tuple[Any, ...]]] = {}
+
+    # ---------- LLM ----------
+    @staticmethod
+    def _messages_key(msgs: List[Dict[str, str]]) -> str:
+        raw = json.dumps(msgs, ensure_ascii=False, sort_keys=True).encode("utf-8")
+        return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+    def _ollama_chat(self, msgs: List[Dict[str, str]]) -> str:
+        """
+        ollama.chat с кэшем по точному совпадению messages (system + контекст + история + вопрос).
+        Ошибки/таймауты не кэшируются — их обрабатывает вызывающий код.
+        """
+        if self.llm_cache_ttl <= 0 or self.llm_cache_max <= 0:
+            return self.ollama.chat(msgs)
+
+        key = self._messages_key(msgs)
+        now = time.time()
+        with self._llm_cache_lock:
+            hit = self._llm_cache.get(key)
+            if hit is not None:
+                if hit[0] > now:
+                    self._llm_cache.move_to_end(key)
+                    return hit[1]
+                del self._llm_cache[key]
+
+        answer = self.ollama.chat(msgs)
+
+        with self._llm_cache_lock:
+            self._llm_cache[key] = (now + self.llm_cache_ttl, answer)
+            self._llm_cache.move_to_end(key)
+            while len(self._llm_cache) > self.llm_cache_max:
+                self._llm_cache.popitem(last=False)
+        return answer
+
+    # ---------- extractors ----------
+    def _extract_fields(self, user_text: str, lower: Optional[str] = None) -> Dict[str, Optional[str]]:
+        """
+        Город/телефон/адрес/дата/время из текста. Зависит только от текста,
+        поэтому кэшируется по одному тексту (результат не мутировать):
+        решения по mem принимает generate_reply.
+        lower — готовый user_text.lower(), чтобы экстракторы не считали его каждый заново.
+        """
+        key = user_text
+        with self._extract_lock:
+            hit = self._extract_cache.get(key)
+            if hit is not None:
+                self._extract_cache.move_to_end(key)
+                return hit
+
+        city = extract_city(user_text)
+        has_digit = DIGIT_RE.search(user_text) is not None
+        if lower is None:
+            lower = user_text.lower()
+        fields: Dict[str, Optional[str]] = {
+            "city": city,
+            "city_candidate": None if city else extract_city_candidate(user_text),
+            "address": extract_address(user_text, has_digit, lower),
+            "visit_date": extract_visit_date(user_text, has_digit, lower),
+            "visit_time": extract_visit_time(user_text, has_digit, lower),
+        }
+
+        with self._extract_lock:
+            self._extract_cache[key] = fields
+            while len(self._extract_cache) > self._extract_cache_max:
+                self._extract_cache.popitem(last=False)
+        return fields
+
+    # ---------- outgoing queues (notify/email) ----------
+    NOTIFY_QUEUE_SIZE = 256
+    NOTIFY_OVERFLOW_SIZE = 1024
+
+    def _start_sink(self, loop, handler: Callable[..., Awaitable[Any]]) -> asyncio.Queue:
+        """
+        Очередь + одна задача, которая по очереди await'ит handler(*args).
+        Вместо create_task на каждое событие: при наплыве «горячих» лидов
+        не плодим тысячи задач. Полная очередь — события ждут в ограниченном
+        overflow-буфере (см. _offer), задач от этого больше не становится.
+        """
+        q: asyncio.Queue = asyncio.Queue(maxsize=self.NOTIFY_QUEUE_SIZE)
+        overflow: Deque[Tuple[Any, ...]] = deque(maxlen=self.NOTIFY_OVERFLOW_SIZE)
+        self._sink_overflow[q] = overflow
+
+        async def _drain() -> None:
+            while True:
+                args = await q.get()
+                # освободилось место — переносим самое старое событие из overflow (порядок FIFO сохраняется)
+                if overflow:
+                    q.put_nowait(overflow.popleft())
+                try:
+                    await handler(*args)
+                except Exception:
+                    pass
+                finally:
+                    q.task_done()
+
+        def _start() -> None:
+            self._sink_workers.append(loop.create_task(_drain()))
+
+        loop.call_soon_threadsafe(_start)
+        return q
+
+    def _offer(self, q: asyncio.Queue, item: Tuple[Any, ...], name: str) -> None:
+        """
+        Выполняется в loop. Пока очередь полна (или overflow ещё не разобран) — событие ждёт
+        в overflow. Теряем только при переполнении и overflow, и всегда с записью в лог.
+        """
+        overflow = self._sink_overflow[q]
+        if not overflow:
+            try:
+                q.put_nowait(item)
+                return
+            except asyncio.QueueFull:
+                print(f"[{name}] queue full ({q.maxsize}), buffering in overflow")
+        if len(overflow) == overflow.maxlen:
+            print(f"[{name}] overflow full ({overflow.maxlen}), dropping oldest event: {str(overflow[0])[:200]!r}")
+        overflow.append(item)
 
     # ---------- notifier (callcenter TG) ----------
     def set_notifier(self, loop, notify_coro_func):
         self._loop = loop
         self._notify_coro = notify_coro_func
+        self._notify_q = self._start_sink(loop, notify_coro_func)
 
     def notify_now(self, text: str) -> None:
-        if not self._loop or not self._notify_coro:
+        if not self._loop or not self._notify_q:
             return
-
-        def _schedule():
-            asyncio.create_task(self._notify_coro(text))
-
-        self._loop.call_soon_threadsafe(_schedule)
+        self._loop.call_soon_threadsafe(self._offer, self._notify_q, (text,), "notify")
 
     # ---------- support / handoff on failures ----------
     def create_support_request(
@@ -830,17 +1318,29 @@ class AppState:
     def set_email_sender(self, loop, email_sender: EmailSender) -> None:
         self._email_loop = loop
         self._email_sender = email_sender
+        self._email_q = self._start_sink(loop, email_sender)
 
     def send_email_now(self, subject: str, body: str, file_path: str) -> None:
-        if not self._email_loop or not self._email_sender:
+        if not self._email_loop or not self._email_q:
             return
         if not file_path:
             return
+        self._email_loop.call_soon_threadsafe(self._offer, self._email_q, (subject, body, file_path), "email")
+
+    def notify_and_email_now(self, text: str, subject: str, body: str, file_path: str) -> None:
+        """Уведомление + письмо по одной заявке: если оба на одном loop — один переход в loop вместо двух."""
+        loop = self._loop
+        if loop is not None and loop is self._email_loop and self._notify_q and self._email_q and file_path:
+            notify_q, email_q = self._notify_q, self._email_q
 
-        def _schedule():
-            asyncio.create_task(self._email_sender(subject, body, file_path))
+            def _both() -> None:
+                self._offer(notify_q, (text,), "notify")
+                self._offer(email_q, (subject, body, file_path), "email")
 
-        self._email_loop.call_soon_threadsafe(_schedule)
+            loop.call_soon_threadsafe(_both)
+            return
+        self.notify_now(text)
+        self.send_email_now(subject, body, file_path)
 
     # ---------- keys/history ----------
     def _key(self, platform: str, user_id: str) -> str:
@@ -866,13 +1366,18 @@ class AppState:
             elif role == "assistant":
                 history.add_assistant(text.strip())
 
-    def get_history(self, platform: str, user_id: str, mem: Dict[str, Any]) -> ChatHistory:
-        k = self._key(platform, user_id)
-        if k not in self.histories:
+    def get_history(
+        self, platform: str, user_id: str, mem: Dict[str, Any], k: Optional[str] = None
+    ) -> ChatHistory:
+        # k — уже посчитанный _key(platform, user_id); горячий путь — один get()
+        if k is None:
+            k = self._key(platform, user_id)
+        h = self.histories.get(k)
+        if h is None:
             h = ChatHistory(self.system_prompt, max_messages=self.max_history)
             self._load_history_from_mem(k, h, mem)
             self.histories[k] = h
-        return self.histories[k]
+        return h
 
     def _push_dialog(self, mem: Dict[str, Any], role: str, text: str, max_items: int = 30) -> None:
         dialog = mem.get("_dialog")
@@ -1008,12 +1513,12 @@ class AppState:
             f"Площадь: {lead.get('area_m2') or '-'}\n"
             f"Допы: {lead.get('extras') or '-'}"
         )
-        self.notify_now(lead_text)
-
         if lead_file_path:
             subject = f"Заявка на замер: {lead.get('city')} / {lead.get('visit_date')} {lead.get('visit_time')}"
             body = lead_text + "\n\nФайл заявки во вложении."
-            self.send_email_now(subject, body, lead_file_path)
+            self.notify_and_email_now(lead_text, subject, body, lead_file_path)
+        else:
+            self.notify_now(lead_text)
 
         return build_lead_confirmation(mem)
 
@@ -1169,16 +1674,19 @@ class AppState:
         meta = meta or {}
         k = self._key(platform, user_id)
 
+        # mem — своя копия из load(); каждый save() ниже стоит перед return, поэтому owned=True
         mem: Dict[str, Any] = self.mem_store.load(k)
         first = not bool(mem.get("_started"))
 
-        history = self.get_history(platform, user_id, mem)
+        history = self.get_history(platform, user_id, mem, k)
 
         user_text = (user_text or "").strip()
         if not user_text:
             return ""
+        # нижний регистр считаем один раз на ход: lower — для detect_intents, low — ещё и ё→е
+        lower = user_text.lower()
+        low = lower.replace("ё", "е")
 
-        
         # --- запрос живого человека / оператора ---
         if detect_handoff_request(user_text):
             # сбрасываем любые "анкеты замера", чтобы не продолжать спрашивать время/адрес
@@ -1208,14 +1716,6 @@ class AppState:
             except Exception:
                 pass
 
-            def _platform_label(p: str) -> str:
-                p = (p or "").lower()
-                return {
-                    "tg": "TG",
-                    "telegram": "TG",
-                    "avito": "Авито",
-                    "vk": "VK",
-                }.get(p, p or "-")
             # уведомление в менеджерский чат
             try:
                 uname = f"@{meta.get('username')}" if meta.get("username") else "-"
@@ -1236,7 +1736,7 @@ class AppState:
             except Exception:
                 pass
 
-            self.mem_store.save(k, mem)
+            self.mem_store.save(k, mem, owned=True)
             return (
                 "Поняла вас 😊 Подключу менеджера.\n"
                 "Пока он подключается, напишите, пожалуйста, одним сообщением: город и что нужно (потолок/шумоизоляция/расчёт).\n"
@@ -1255,8 +1755,8 @@ class AppState:
         is_pure_greeting = (
             bool(wants_greet)
             and len((user_text or "").strip().split()) <= 3
-            and not re.search(r"\d", user_text or "")
-            and not re.search(r"\b(потолк|натяж|шумо|звуко|изоляц|цена|стоим|сколько)\b", user_text or "", re.IGNORECASE)
+            and not DIGIT_RE.search(user_text or "")
+            and not _GREET_TOPIC_RE.search(user_text or "")
         )
 
         if is_pure_greeting and not mem.get("city") and not mem.get("area_m2"):
@@ -1264,7 +1764,7 @@ class AppState:
             history.add_assistant(ans)
             self._push_dialog(mem, "assistant", ans)
             mem["_started"] = True
-            self.mem_store.save(k, mem)
+            self.mem_store.save(k, mem, owned=True)
             return ans
 
 
@@ -1312,18 +1812,16 @@ class AppState:
 
         # углы/профиль — полезно для контекста (даже если в pricing_rules пока не учтены)
         try:
-            low = (user_text or "").lower().replace("ё", "е")
-            m_ang = re.search(r"\b(\d{1,2})\s*(угл\w*)\b", low)
+            m_ang = _ANGLES_RE.search(low)
             if m_ang:
                 mem["angles"] = int(m_ang.group(1))
         except Exception:
             pass
 
         try:
-            low = (user_text or "").lower().replace("ё", "е")
-            if re.search(r"\bне\s+парящ", low):
+            if _NOT_FLOATING_RE.search(low):
                 mem["profile"] = "standard"
-            elif re.search(r"\bпарящ", low):
+            elif _FLOATING_RE.search(low):
                 mem["profile"] = "floating"
         except Exception:
             pass
@@ -1353,54 +1851,63 @@ class AppState:
 
         # эвристика площади: ловим число даже без "кв.м"
         # ВАЖНО: не подменяем "3 потолка/3 комнаты" на "3 м²" — это ломает диалог.
-        cleaned = PHONE_ANY_RE.sub(" ", user_text)
-        nums = [int(n) for n in re.findall(r"\b(\d{1,3})\b", cleaned)]
-        nums = [n for n in nums if 1 <= n <= 300]
-        has_area_hint = bool(AREA_HINT_RE.search(cleaned) or re.search(r"\bплощад", cleaned, re.IGNORECASE))
-        looks_like_rooms = bool(re.search(r"\b(потолк|комнат|уровн|помещен)\b", cleaned, re.IGNORECASE))
-
-        if nums and has_area_hint:
-            mem["area_m2"] = float(max(nums))
-        elif nums and (mem.get("asked_area") or mem.get("asked_area_soundproof")) and not looks_like_rooms:
-            # пользователь отвечает просто числом на вопрос про площадь
-            mem["area_m2"] = float(max(nums))
+        # без цифр нет ни телефона, ни площади — большинство реплик не гоняет эти regex вовсе
+        ph: Optional[str] = None
+        best_num: Optional[int] = None
+        if DIGIT_RE.search(user_text):
+            ph, cleaned = split_phone_and_rest(user_text)
+            # один проход: максимум среди чисел 1..300, без промежуточных списков
+            best_num = max((n for n in map(int, AREA_NUM_RE.findall(cleaned)) if 1 <= n <= 300), default=None)
+        if best_num is not None:
+            has_area_hint = bool(AREA_HINT_RE.search(cleaned) or _AREA_WORD_RE.search(cleaned))
+            if has_area_hint:
+                mem["area_m2"] = float(best_num)
+            elif (mem.get("asked_area") or mem.get("asked_area_soundproof")) and not _AREA_COUNT_NOUN_RE.search(cleaned):
+                # пользователь отвечает просто числом на вопрос про площадь
+                mem["area_m2"] = float(best_num)
 
         if platform == "avito":
-            if mem.get("city") and mem.get("area_m2") and not detect_price_question(user_text):
+            if mem.get("city") and mem.get("area_m2") and not detect_price_question(user_text, lower):
                 # чтобы не повторять один и тот же расчет бесконечно:
                 marker = f"{mem.get('city')}|{mem.get('area_m2')}"
                 if mem.get("last_auto_estimate") != marker:
                     mem["last_auto_estimate"] = marker
                     # принудительно считаем как price question
-                    user_text = user_text + " (рассчитай стоимость)"
+                    user_text = user_text + AUTO_ESTIMATE_MARKER
+                    lower += AUTO_ESTIMATE_MARKER
+                    low += AUTO_ESTIMATE_MARKER
+        # все намерения по окончательному user_text — один раз
+        intents = detect_intents(user_text, lower)
+
+        fields = self._extract_fields(user_text, lower)
+
         # ---- city handling ----
-        supported_city = extract_city(user_text)
+        supported_city = fields["city"]
         if supported_city:
             mem["city"] = supported_city
             mem.pop("unsupported_city_candidate", None)
         else:
-            cand = extract_city_candidate(user_text)
+            cand = fields["city_candidate"]
             if cand:
                 # если явно сказал город, но мы его не поддерживаем — отвечаем сразу
                 mem["unsupported_city_candidate"] = cand
 
         # ---- phone/address/date/time ----
-        if detect_phone_refusal(user_text):
+        if intents & INTENT_PHONE_REFUSAL:
             mem["no_phone"] = True
-        ph = extract_phone(user_text)
         if ph:
             mem["phone"] = ph
             mem.pop("no_phone", None)
 
-        addr = extract_address(user_text)
+        addr = fields["address"]
         if addr:
             mem["address"] = addr
 
-        vdate = extract_visit_date(user_text)
+        vdate = fields["visit_date"]
         if vdate:
             mem["visit_date"] = vdate
 
-        vt = extract_visit_time(user_text)
+        vt = fields["visit_time"]
         if vt:
             mem["visit_time"] = vt
 
@@ -1410,18 +1917,8 @@ class AppState:
         hot_fields += 1 if mem.get("visit_time") else 0
         hot_fields += 1 if mem.get("phone") else 0
 
-        hot_intent = detect_measurement_booking_intent(user_text) or detect_affirm(user_text)
-        hot_discount = detect_discount_mention(user_text) and bool(mem.get("area_m2") and mem.get("city"))
-
-        def _platform_label(p: str) -> str:
-            p = (p or "").lower()
-            return {
-                "avito": "Авито",
-                "tg": "TG",
-                "telegram": "TG",
-                "vk": "VK",
-                "whatsapp": "WA",
-            }.get(p, p or "-")
+        hot_intent = bool(intents & (INTENT_MEASURE_BOOK | INTENT_AFFIRM))
+        hot_discount = bool(intents & INTENT_DISCOUNT) and bool(mem.get("area_m2") and mem.get("city"))
 
         def _lead_key() -> str:
             # service важен: у одного user_id могут быть разные товары/воронки
@@ -1540,11 +2037,11 @@ class AppState:
             history.add_assistant(ans)
             self._push_dialog(mem, "assistant", ans)
             mem["_started"] = True
-            self.mem_store.save(k, mem)
+            self.mem_store.save(k, mem, owned=True)
             return ans
 
         # ---- вопросы про выезд за пределы города (сначала уточняем город, доп.стоимость не озвучиваем) ----
-        if detect_out_of_city_question(user_text):
+        if intents & INTENT_OUT_OF_CITY:
             if not mem.get("city"):
                 mem["asked_city"] = True
                 ans = build_out_of_city_need_city(greet)
@@ -1555,14 +2052,14 @@ class AppState:
             history.add_assistant(ans)
             self._push_dialog(mem, "assistant", ans)
             mem["_started"] = True
-            self.mem_store.save(k, mem)
+            self.mem_store.save(k, mem, owned=True)
             return ans
 
         # ---- потолки: если уже есть город+площадь, не уводим в "анкету" — даём ориентир сразу ----
         if (mem.get("service") or "ceiling") != "soundproof":
             if mem.get("city") and mem.get("area_m2") and not mem.get("price_given"):
                 # если клиент прямо просит записать/"давайте" — пусть уходит в замер-ветку ниже
-                if not (detect_measurement_booking_intent(user_text) or detect_affirm(user_text)):
+                if not intents & (INTENT_MEASURE_BOOK | INTENT_AFFIRM):
                     est = self.pricing.calculate(city=str(mem.get("city")), area_m2=float(mem.get("area_m2")), extras=_extras_for_pricing())
                     if getattr(est, "min_price", None) is not None:
                         mem["price_given"] = True
@@ -1577,7 +2074,7 @@ class AppState:
                         history.add_assistant(ans)
                         self._push_dialog(mem, "assistant", ans)
                         mem["_started"] = True
-                        self.mem_store.save(k, mem)
+                        self.mem_store.save(k, mem, owned=True)
                         return ans
 
         # ---- отдельный товар: шумо/звукоизоляция под ключ ----
@@ -1588,10 +2085,10 @@ class AppState:
                 ans = build_soundproofing_need_city(greet)
             else:
                 # если спрашивает цену или просто прислал площадь — даём ориентир
-                if not mem.get("area_m2") and (detect_price_question(user_text) or mem.get("calc_only")):
+                if not mem.get("area_m2") and (intents & INTENT_PRICE or mem.get("calc_only")):
                     mem["asked_area"] = True
                     ans = build_soundproofing_need_area(greet, str(mem.get("city")))
-                elif mem.get("area_m2") and (detect_price_question(user_text) or detect_soundproofing_question(user_text) or mem.get("calc_only")):
+                elif mem.get("area_m2") and (intents & (INTENT_PRICE | INTENT_SOUNDPROOF) or mem.get("calc_only")):
                     ans = build_soundproofing_estimate(greet, str(mem.get("city")), float(mem.get("area_m2")))
                 else:
                     ans = build_soundproofing_info(greet, mem.get("city"))
@@ -1600,11 +2097,11 @@ class AppState:
             history.add_assistant(ans)
             self._push_dialog(mem, "assistant", ans)
             mem["_started"] = True
-            self.mem_store.save(k, mem)
+            self.mem_store.save(k, mem, owned=True)
             return ans
 
         # Если объявление про потолки, но клиент уточняет про шумоизоляцию — кратко ответим (без перевода в другой товар).
-        if detect_soundproofing_question(user_text):
+        if intents & INTENT_SOUNDPROOF:
             mem["soundproof_pending"] = True
             mem["soundproof_pending_ts"] = time.time()
             if not mem.get("city"):
@@ -1617,7 +2114,7 @@ class AppState:
             history.add_assistant(ans)
             self._push_dialog(mem, "assistant", ans)
             mem["_started"] = True
-            self.mem_store.save(k, mem)
+            self.mem_store.save(k, mem, owned=True)
             return ans
 
         # follow-up: если недавно обсуждали шумоизоляцию и клиент прислал город/площадь
@@ -1629,7 +2126,7 @@ class AppState:
                 mem.pop("asked_area_soundproof", None)
             else:
                 # если клиент явно вернулся к потолкам — снимаем ожидание
-                if re.search(r"\b(потолк|натяж)\w*\b", user_text, re.IGNORECASE) and not detect_soundproofing_question(user_text):
+                if _CEILING_RE.search(user_text) and not intents & INTENT_SOUNDPROOF:
                     mem.pop("soundproof_pending", None)
                     mem.pop("soundproof_pending_ts", None)
                     mem.pop("asked_area_soundproof", None)
@@ -1641,7 +2138,7 @@ class AppState:
                         history.add_assistant(ans)
                         self._push_dialog(mem, "assistant", ans)
                         mem["_started"] = True
-                        self.mem_store.save(k, mem)
+                        self.mem_store.save(k, mem, owned=True)
                         return ans
 
                     if not mem.get("area_m2"):
@@ -1651,7 +2148,7 @@ class AppState:
                         history.add_assistant(ans)
                         self._push_dialog(mem, "assistant", ans)
                         mem["_started"] = True
-                        self.mem_store.save(k, mem)
+                        self.mem_store.save(k, mem, owned=True)
                         return ans
 
                     # есть город и площадь — считаем
@@ -1664,11 +2161,11 @@ class AppState:
                     history.add_assistant(ans)
                     self._push_dialog(mem, "assistant", ans)
                     mem["_started"] = True
-                    self.mem_store.save(k, mem)
+                    self.mem_store.save(k, mem, owned=True)
                     return ans
 
         # ---- скидки ----
-        if detect_discount_mention(user_text):
+        if intents & INTENT_DISCOUNT:
             mem["measure_offer_pending"] = True
             msg = build_discounts_message(greet, mem.get("city"))
             msg = sanitize_answer(msg, allow_greet=greet)
@@ -1677,7 +2174,7 @@ class AppState:
             self._push_dialog(mem, "assistant", msg)
 
             mem["_started"] = True
-            self.mem_store.save(k, mem)
+            self.mem_store.save(k, mem, owned=True)
 
             # для TG можем вернуть маркер под картинку
             if platform == "tg":
@@ -1687,28 +2184,24 @@ class AppState:
         # ---- намерения ----
         # если клиент уточняет допы (люстры/карниз/углы/профиль и т.п.),
         # обычно он ждёт пересчёт — даже если не написал слово "цена".
-        low_now = (user_text or "").lower().replace("ё", "е")
         spec_update = bool(
             (getattr(extracted, "extras_counts", None) and extracted.extras_counts)
             or (getattr(extracted, "extras", None) and extracted.extras)
-            or re.search(r"\bугл\w*\b", low_now)
-            or re.search(r"\bпарящ\w*\b", low_now)
-            or re.search(r"\bплинтус\w*\b", low_now)
-            or re.search(r"\bподсвет\w*\b", low_now)
+            or _SPEC_UPDATE_RE.search(low)
         )
 
-        price_q = detect_price_question(user_text) or bool(mem.get("calc_only")) or (spec_update and bool(mem.get("city") and mem.get("area_m2")))
-        book_measure = detect_measurement_booking_intent(user_text)
-        info_measure = detect_measurement_info_question(user_text)
+        price_q = bool(intents & INTENT_PRICE) or bool(mem.get("calc_only")) or (spec_update and bool(mem.get("city") and mem.get("area_m2")))
+        book_measure = bool(intents & INTENT_MEASURE_BOOK)
+        info_measure = bool(intents & INTENT_MEASURE_INFO)
 
         # отказ от замера / только расчёт
-        if detect_measurement_decline(user_text) or detect_calc_only(user_text):
+        if intents & (INTENT_MEASURE_DECLINE | INTENT_CALC_ONLY):
             mem["calc_only"] = True
             mem.pop("agreed_measurement", None)
 
         # если ранее предложили замер и клиент прислал "да/дата/время/адрес"
         if mem.get("measure_offer_pending") and not mem.get("agreed_measurement"):
-            if detect_affirm(user_text) or book_measure or addr or vdate or vt:
+            if intents & INTENT_AFFIRM or book_measure or addr or vdate or vt:
                 mem["agreed_measurement"] = True
                 mem.pop("measure_offer_pending", None)
                 mem.pop("calc_only", None)
@@ -1739,7 +2232,7 @@ class AppState:
                 history.add_assistant(ans)
                 self._push_dialog(mem, "assistant", ans)
                 mem["_started"] = True
-                self.mem_store.save(k, mem)
+                self.mem_store.save(k, mem, owned=True)
                 return ans
 
             if not mem.get("area_m2"):
@@ -1749,7 +2242,7 @@ class AppState:
                 history.add_assistant(ans)
                 self._push_dialog(mem, "assistant", ans)
                 mem["_started"] = True
-                self.mem_store.save(k, mem)
+                self.mem_store.save(k, mem, owned=True)
                 return ans
 
             # 2) считаем ориентир
@@ -1761,7 +2254,7 @@ class AppState:
                 history.add_assistant(ans)
                 self._push_dialog(mem, "assistant", ans)
                 mem["_started"] = True
-                self.mem_store.save(k, mem)
+                self.mem_store.save(k, mem, owned=True)
                 return ans
 
             minp = int(estimate.min_price)
@@ -1792,13 +2285,13 @@ class AppState:
                     ans = "Поняла, учла ✅\n" + ("\n".join(prefix_lines) + "\n\n" if prefix_lines else "") + base_msg
                 elif detect_materials_question(user_text):
                     ans = build_materials_vs_turnkey(greet)
-                elif "дорог" in (user_text or "").lower():
+                elif "дорог" in lower:
                     ans = (
                         "Понимаю 😊\n"
                         "Можем сделать дешевле: матовый/сатин, простой профиль и без сложных ниш.\n"
                         "Хотите — подберу минимальный вариант под ваш бюджет. Сколько светильников планируете?"
                     )
-                elif detect_measurement_booking_intent(user_text) and not mem.get("calc_only"):
+                elif intents & INTENT_MEASURE_BOOK and not mem.get("calc_only"):
                     mem["agreed_measurement"] = True
                     ans = build_measure_intro(first)
                 else:
@@ -1839,7 +2332,7 @@ class AppState:
             history.add_assistant(ans)
             self._push_dialog(mem, "assistant", ans)
             mem["_started"] = True
-            self.mem_store.save(k, mem)
+            self.mem_store.save(k, mem, owned=True)
             return ans
 
 
@@ -1855,7 +2348,7 @@ class AppState:
             history.add_assistant(ans)
             self._push_dialog(mem, "assistant", ans)
             mem["_started"] = True
-            self.mem_store.save(k, mem)
+            self.mem_store.save(k, mem, owned=True)
             return ans
 
         # ------------------- 3) оформление лида на замер -------------------
@@ -1865,7 +2358,7 @@ class AppState:
             history.add_assistant(lead_flow)
             self._push_dialog(mem, "assistant", lead_flow)
             mem["_started"] = True
-            self.mem_store.save(k, mem)
+            self.mem_store.save(k, mem, owned=True)
             return lead_flow
 
         # ------------------- 3.5) вежливое завершение диалога -------------------
@@ -1874,7 +2367,7 @@ class AppState:
             history.add_assistant(ans)
             self._push_dialog(mem, "assistant", ans)
             mem["_started"] = True
-            self.mem_store.save(k, mem)
+            self.mem_store.save(k, mem, owned=True)
             return ans
 
         # ------------------- 4) старт -------------------
@@ -1883,7 +2376,7 @@ class AppState:
             history.add_assistant(ans)
             self._push_dialog(mem, "assistant", ans)
             mem["_started"] = True
-            self.mem_store.save(k, mem)
+            self.mem_store.save(k, mem, owned=True)
             return ans
 
         # ------------------- 5) fallback LLM (но с контекстом переписки) -------------------
@@ -1913,27 +2406,40 @@ class AppState:
             if isinstance(it, dict) and isinstance(it.get("text"), str) and isinstance(it.get("role"), str):
                 role = "Клиент" if it["role"] == "user" else "Менеджер"
                 last_turns.append(f"{role}: {it['text']}")
-        if last_turns:
-            context_parts.append("Последние сообщения:\n" + "\n".join(last_turns))
-
         context_parts.append(f"Сообщение клиента: {user_text}")
+
+        # бюджет токенов на блок фактов: длинная переписка не должна раздувать prefill.
+        # Факты (город/площадь/допы/оценка) остаются всегда, выкидываем самые старые реплики.
+        if last_turns:
+            fixed_tokens = _approx_tokens("\n".join(context_parts))
+            while last_turns and fixed_tokens + _approx_tokens("\n".join(last_turns)) > self.context_token_budget:
+                last_turns.pop(0)
+        if last_turns:
+            context_parts.insert(-1, "Последние сообщения:\n" + "\n".join(last_turns))
         context = "\n".join(context_parts)
 
         msgs = history.to_ollama_messages()
 
-        # system prompt уже есть (msgs[0]). Сначала добавим факты-контекст,
-        # затем few-shot примеры, затем уже история переписки.
-        insert_at = 1
+        # Порядок ради KV-кэша префикса в Ollama: system prompt → few-shot → история → факты → сообщение клиента.
+        # Всё до фактов от хода к ходу только дописывается в конец, поэтому префикс переиспользуется.
+        # Факты меняются каждый ход — это по-прежнему system-сообщение, но в хвосте, перед репликой клиента.
         if context:
-            msgs.insert(insert_at, {"role": "system", "content": context})
-            insert_at += 1
-
-        fewshot_msgs = self.fewshot.select(user_text=user_text, mem=mem, k=self.fewshot_k)
+            at = len(msgs) - 1 if len(msgs) > 1 and msgs[-1].get("role") == "user" else len(msgs)
+            msgs.insert(at, {"role": "system", "content": context})
+
+        # few-shot выбираем один раз на диалог (и заново — только при смене услуги) и держим в mem:
+        # выбор по каждому новому сообщению менял бы сообщения сразу после system prompt.
+        fewshot_service = mem.get("service") or ("soundproof" if mem.get("soundproof_pending") else "ceiling")
+        pin = mem.get("_fewshot")
+        if not (isinstance(pin, dict) and pin.get("service") == fewshot_service and isinstance(pin.get("ids"), list)):
+            pin = {"service": fewshot_service, "ids": self.fewshot.pick(user_text=user_text, mem=mem, k=self.fewshot_k)}
+            mem["_fewshot"] = pin
+        fewshot_msgs = self.fewshot.messages(pin["ids"])
         if fewshot_msgs:
-            msgs[insert_at:insert_at] = fewshot_msgs
+            msgs[1:1] = fewshot_msgs
 
         try:
-            answer = self.ollama.chat(msgs)
+            answer = self._ollama_chat(msgs)
         except LLMTimeoutError:
             # UX-friendly fallback on LLM timeout.
             # Важно: НЕ падать (никаких неопределённых переменных / несуществующих методов).
@@ -1969,5 +2475,5 @@ class AppState:
         self._push_dialog(mem, "assistant", answer)
 
         mem["_started"] = True
-        self.mem_store.save(k, mem)
+        self.mem_store.save(k, mem, owned=True)
         return answer
\ No newline at end of file
@@ -1,7 +1,7 @@
 # core/avito_api.py
 from __future__ import annotations
 
-import json
+import threading
 import time
 from dataclasses import dataclass
 from pathlib import Path
@@ -9,6 +9,14 @@ from typing import Any, Dict, List, Optional, Tuple
 
 import httpx
 
+from core import jsonio
+
+try:
+    import h2  # noqa: F401  (httpx[http2])
+    _HAS_H2 = True
+except ImportError:  # h2 опционален: без него остаёмся на HTTP/1.1
+    _HAS_H2 = False
+
 
 class AvitoAPIError(RuntimeError):
     def __init__(
@@ -52,6 +60,9 @@ class AvitoAPI:
         token_path: str = "data/avito_tokens.json",
         base_url: str = "https://api.avito.ru",
         timeout: float = 30.0,
+        max_connections: int = 16,
+        keepalive_expiry: float = 90.0,
+        http2: bool = False,
     ) -> None:
         self.client_id = (client_id or "").strip()
         self.client_secret = (client_secret or "").strip()
@@ -63,15 +74,39 @@ class AvitoAPI:
         self.token_path = Path(token_path)
         self.token_path.parent.mkdir(parents=True, exist_ok=True)
 
-        self._http = httpx.Client(base_url=self.base_url, timeout=self.timeout)
+        # Один клиент на весь процесс: keep-alive пул переиспользует TCP/TLS между тиками poller'а.
+        # keepalive_expiry больше максимального интервала опроса (AVITO_POLL_MAX), иначе
+        # соединение закрывается между тиками и каждый тик платит за новый TLS handshake.
+        # http2: параллельные запросы чатов мультиплексируются в одном соединении (нужен пакет h2).
+        self.http2 = bool(http2) and _HAS_H2
+        self._http = httpx.Client(
+            base_url=self.base_url,
+            timeout=self.timeout,
+            http2=self.http2,
+            headers={"Accept": "application/json"},
+            limits=httpx.Limits(
+                max_connections=int(max_connections),
+                max_keepalive_connections=int(max_connections),
+                keepalive_expiry=float(keepalive_expiry),
+            ),
+        )
         self._token: Optional[AvitoToken] = self._load_token()
+        # poller зовёт клиент из нескольких потоков: проверка+обновление токена — под локом,
+        # чтобы не было параллельных /token/ и гонок записи файла токена
+        self._token_lock = threading.Lock()
+        # (токен, готовые заголовки): пересобираем только когда сменился сам токен
+        self._auth_cache: Optional[Tuple[AvitoToken, Dict[str, str]]] = None
+
+        # ETag-кэш списков: ключ запроса -> (etag, уже разобранный список)
+        self._etag_cache: Dict[str, Tuple[str, List[Dict[str, Any]]]] = {}
+        self._etag_lock = threading.Lock()
 
     # ---------------- token ----------------
     def _load_token(self) -> Optional[AvitoToken]:
         if not self.token_path.exists():
             return None
         try:
-            d = json.loads(self.token_path.read_text(encoding="utf-8"))
+            d = jsonio.loads(self.token_path.read_bytes())
             if not isinstance(d, dict) or not d.get("access_token"):
                 return None
             return AvitoToken(
@@ -84,16 +119,18 @@ class AvitoAPI:
 
     def _save_token(self, t: AvitoToken) -> None:
         self._token = t
-        self.token_path.write_text(
-            json.dumps(
+        self.token_path.write_bytes(
+            jsonio.dumps(
                 {"access_token": t.access_token, "token_type": t.token_type, "expires_at": t.expires_at},
-                ensure_ascii=False,
-                indent=2,
-            ),
-            encoding="utf-8",
+                indent=True,
+            )
         )
 
     def refresh_token(self) -> AvitoToken:
+        with self._token_lock:
+            return self._refresh_locked()
+
+    def _refresh_locked(self) -> AvitoToken:
         r = self._http.post(
             "/token/",
             headers={"Content-Type": "application/x-www-form-urlencoded", "Accept": "application/json"},
@@ -111,7 +148,7 @@ class AvitoAPI:
                 request_id=r.headers.get("x-request-id", ""),
             )
 
-        j = r.json()
+        j = jsonio.loads(r.content)
         expires_in = int(j.get("expires_in", 86400))
 
         t = AvitoToken(
@@ -122,19 +159,42 @@ class AvitoAPI:
         self._save_token(t)
         return t
 
-    def ensure_token(self, refresh_if_less_than_sec: int = 3600) -> None:
-        if self._token and self._token.is_valid(skew_sec=30):
-            if (self._token.expires_at - time.time()) > int(refresh_if_less_than_sec):
-                return
-        self.refresh_token()
+    def _fresh(self, t: Optional[AvitoToken], refresh_if_less_than_sec: int) -> bool:
+        return bool(
+            t and t.is_valid(skew_sec=30) and (t.expires_at - time.time()) > int(refresh_if_less_than_sec)
+        )
 
-    def _auth_headers(self) -> Dict[str, str]:
-        self.ensure_token()
-        assert self._token
-        return {
-            "Authorization": f"{self._token.token_type} {self._token.access_token}",
-            "Accept": "application/json",
-        }
+    def ensure_token(self, refresh_if_less_than_sec: int = 3600) -> AvitoToken:
+        t = self._token
+        if t is not None and self._fresh(t, refresh_if_less_than_sec):
+            return t
+        with self._token_lock:
+            # пока ждали лок, токен мог обновить другой поток
+            t = self._token
+            if t is not None and self._fresh(t, refresh_if_less_than_sec):
+                return t
+            return self._refresh_locked()
+
+    def _refresh_rejected(self, rejected: AvitoToken) -> AvitoToken:
+        """Сервер отверг токен (401/403): обновляем, только если его ещё не заменил другой поток."""
+        with self._token_lock:
+            t = self._token
+            if t is not None and t is not rejected:
+                return t
+            return self._refresh_locked()
+
+    def _auth_headers(self, t: Optional[AvitoToken] = None) -> Dict[str, str]:
+        if t is None:
+            t = self.ensure_token()
+        cached = self._auth_cache
+        if cached is None or cached[0] is not t:
+            cached = (t, {
+                "Authorization": f"{t.token_type} {t.access_token}",
+                "Accept": "application/json",
+            })
+            self._auth_cache = cached
+        # общий dict на все запросы — не мутировать (в _request_json сливаем в новый)
+        return cached[1]
 
     # ---------------- request helpers ----------------
     def _request_json(
@@ -144,18 +204,25 @@ class AvitoAPI:
         params: Optional[Dict[str, Any]] = None,
         json_body: Optional[Dict[str, Any]] = None,
         allow_statuses: Tuple[int, ...] = (),
+        headers: Optional[Dict[str, str]] = None,
     ) -> Tuple[int, Any, httpx.Response]:
-        r = self._http.request(method, path, headers=self._auth_headers(), params=params, json=json_body)
+        def _headers(t: AvitoToken) -> Dict[str, str]:
+            h = self._auth_headers(t)
+            if headers:
+                h = {**h, **headers}
+            return h
+
+        t = self.ensure_token()
+        r = self._http.request(method, path, headers=_headers(t), params=params, json=json_body)
 
-        # если токен протух — обновим и повторим 1 раз
+        # если токен протух — обновим и повторим 1 раз (общий self._token не обнуляем: его читают другие потоки)
         if r.status_code in (401, 403):
-            self._token = None
-            self.ensure_token()
-            r = self._http.request(method, path, headers=self._auth_headers(), params=params, json=json_body)
+            t = self._refresh_rejected(t)
+            r = self._http.request(method, path, headers=_headers(t), params=params, json=json_body)
 
         if allow_statuses and r.status_code in allow_statuses:
             try:
-                return r.status_code, r.json(), r
+                return r.status_code, jsonio.loads(r.content), r
             except Exception:
                 return r.status_code, r.text, r
 
@@ -168,7 +235,7 @@ class AvitoAPI:
             )
 
         try:
-            return r.status_code, r.json(), r
+            return r.status_code, jsonio.loads(r.content), r
         except Exception:
             return r.status_code, r.text, r
 
@@ -183,6 +250,35 @@ class AvitoAPI:
                     return [x for x in v if isinstance(x, dict)]
         return []
 
+    def _get_list(self, path: str, params: Optional[Dict[str, Any]] = None) -> Tuple[int, List[Dict[str, Any]]]:
+        """
+        GET списка с If-None-Match: если сервер ответил 304 — отдаём прошлый разобранный список,
+        ничего не декодируя заново.
+        """
+        key = f"{path}?{sorted((params or {}).items())}"
+        with self._etag_lock:
+            cached = self._etag_cache.get(key)
+        code, data, r = self._request_json(
+            "GET",
+            path,
+            params=params,
+            allow_statuses=(400, 403, 404),
+            headers={"If-None-Match": cached[0]} if cached else None,
+        )
+        if code == 304 and cached:
+            return code, cached[1]
+        if code >= 400:
+            return code, []
+
+        items = self._pick_list(data)
+        etag = r.headers.get("etag", "")
+        with self._etag_lock:
+            if etag:
+                self._etag_cache[key] = (etag, items)
+            else:
+                self._etag_cache.pop(key, None)
+        return code, items
+
     # ---------------- messenger ----------------
     def get_chat(self, chat_id: str) -> Dict[str, Any]:
         # иногда работает, иногда 404 (как у тебя) — поэтому poller на это не опирается
@@ -197,31 +293,21 @@ class AvitoAPI:
         """
         # v2 без params
         for p in (f"/messenger/v2/accounts/{self.user_id}/chats", f"/messenger/v2/accounts/{self.user_id}/chats/"):
-            code, data, _ = self._request_json("GET", p, allow_statuses=(400, 403, 404))
+            code, items = self._get_list(p)
             if code < 400:
-                return self._pick_list(data)
+                return items
 
         # v1 с пагинацией
         for p in (f"/messenger/v1/accounts/{self.user_id}/chats", f"/messenger/v1/accounts/{self.user_id}/chats/"):
-            code, data, _ = self._request_json(
-                "GET",
-                p,
-                params={"limit": int(limit), "offset": int(offset)},
-                allow_statuses=(400, 403, 404),
-            )
+            code, items = self._get_list(p, params={"limit": int(limit), "offset": int(offset)})
             if code < 400:
-                return self._pick_list(data)
+                return items
 
         # v2 с params (на всякий)
         for p in (f"/messenger/v2/accounts/{self.user_id}/chats", f"/messenger/v2/accounts/{self.user_id}/chats/"):
-            code, data, _ = self._request_json(
-                "GET",
-                p,
-                params={"limit": int(limit), "offset": int(offset)},
-                allow_statuses=(400, 403, 404),
-            )
+            code, items = self._get_list(p, params={"limit": int(limit), "offset": int(offset)})
             if code < 400:
-                return self._pick_list(data)
+                return items
 
         return []
 
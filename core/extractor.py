@@ -42,8 +42,21 @@ _NUM_WORDS = {
     "десять": 10,
 }
 
+# extract_* вызываются на каждое сообщение — шаблоны компилируем один раз при импорте
+_CHANDELIER_NUM_RE = re.compile(r"\b(\d{1,3})\s*(люстр\w*)\b")
+_LIGHT_NUM_RE = re.compile(r"\b(\d{1,3})\s*(светильник\w*|точк\w*\s*светильник\w*|спот\w*)\b")
+_CHANDELIER_WORD_RE = re.compile(rf"\b({'|'.join(map(re.escape, _NUM_WORDS.keys()))})\s*(люстр\w*)\b")
+_CORNICE_LEN_RE = re.compile(r"карниз[^\n\r]{0,60}?(\d{1,3}(?:[\.,]\d+)?)\s*(?:м\b|метр\w*)")
 
-def extract_extras_counts(text: str) -> Dict[str, int]:
+_AREA_UNIT = r"(?:м2|м\^2|м²|кв\.?\s*м|кв\.?\s*метр(?:а|ов)?|квадратн\w*\s*метр(?:а|ов)?|квадрат(?:а|ов)?|кв\.?\b|квм\b)"
+_AREA_RANGE_RE = re.compile(rf"(\d{{1,3}}(?:\.\d+)?)\s*[\-–—]\s*(\d{{1,3}}(?:\.\d+)?)\s*{_AREA_UNIT}")
+_AREA_RE = re.compile(rf"(\d{{1,3}}(?:\.\d+)?)\s*{_AREA_UNIT}")
+
+# «,»→«.» и «ё»→«е» одним translate: общий нормализованный текст для площади и количеств
+_NORM_TABLE = str.maketrans({",": ".", "ё": "е"})
+
+
+def extract_extras_counts(text: str, norm: Optional[str] = None) -> Dict[str, int]:
     """Пробует извлечь количества по ключевым допам.
 
     Возвращает counts по тем позициям, где количество указано явно:
@@ -52,8 +65,9 @@ def extract_extras_counts(text: str) -> Dict[str, int]:
     - карниз 3 м / 3 метра карниза
 
     Примечание: углы/профиль мы храним отдельно (в app_state), т.к. в pricing_rules их может не быть.
+    norm — уже нормализованный текст из extract_info (запятые в нём уже точки, шаблоны это допускают).
     """
-    t = (text or "").lower().replace("ё", "е")
+    t = norm if norm is not None else (text or "").lower().replace("ё", "е")
     counts: Dict[str, int] = {}
 
     def _add(name: str, n: int) -> None:
@@ -62,19 +76,18 @@ def extract_extras_counts(text: str) -> Dict[str, int]:
         counts[name] = int(counts.get(name, 0) + int(n))
 
     # 1) digits: "3 люстры", "7 светильников"
-    for n, _ in re.findall(r"\b(\d{1,3})\s*(люстр\w*)\b", t):
+    for n, _ in _CHANDELIER_NUM_RE.findall(t):
         _add("люстра", int(n))
 
-    for n, _ in re.findall(r"\b(\d{1,3})\s*(светильник\w*|точк\w*\s*светильник\w*|спот\w*)\b", t):
+    for n, _ in _LIGHT_NUM_RE.findall(t):
         _add("светильник", int(n))
 
     # 2) word-numbers: "одна люстра", "две люстры"
-    words_re = "|".join(map(re.escape, _NUM_WORDS.keys()))
-    for w, _ in re.findall(rf"\b({words_re})\s*(люстр\w*)\b", t):
+    for w, _ in _CHANDELIER_WORD_RE.findall(t):
         _add("люстра", _NUM_WORDS.get(w, 0))
 
     # 3) карниз: если указана длина в метрах — считаем как количество метров (округляем вверх)
-    m = re.search(r"карниз[^\n\r]{0,60}?(\d{1,3}(?:[\.,]\d+)?)\s*(?:м\b|метр\w*)", t)
+    m = _CORNICE_LEN_RE.search(t)
     if m:
         try:
             val = float(m.group(1).replace(",", "."))
@@ -90,7 +103,7 @@ def extract_extras_counts(text: str) -> Dict[str, int]:
     return counts
 
 
-def extract_area_m2(text: str) -> Optional[float]:
+def extract_area_m2(text: str, norm: Optional[str] = None) -> Optional[float]:
     """Пробует извлечь площадь из текста.
 
     Поддерживает варианты:
@@ -98,13 +111,12 @@ def extract_area_m2(text: str) -> Optional[float]:
     - 20 кв м / 20 кв.м / 20кв.м / 20 кв
     - 20 квадратов / 20 квадратных метров
     - диапазоны: 20-25 кв (берём верхнюю границу, чтобы не занижать ориентир)
+    norm — уже нормализованный текст из extract_info.
     """
-    t = (text or "").lower().replace(",", ".")
-
-    unit = r"(?:м2|м\^2|м²|кв\.?\s*м|кв\.?\s*метр(?:а|ов)?|квадратн\w*\s*метр(?:а|ов)?|квадрат(?:а|ов)?|кв\.?\b|квм\b)"
+    t = norm if norm is not None else (text or "").lower().replace(",", ".")
 
     # 1) диапазон 20-25 кв.м
-    m = re.search(rf"(\d{{1,3}}(?:\.\d+)?)\s*[\-–—]\s*(\d{{1,3}}(?:\.\d+)?)\s*{unit}", t)
+    m = _AREA_RANGE_RE.search(t)
     if m:
         try:
             a = float(m.group(1))
@@ -116,7 +128,7 @@ def extract_area_m2(text: str) -> Optional[float]:
             return None
 
     # 2) одиночное значение 20кв / 20 кв.м / 20 м²
-    m = re.search(rf"(\d{{1,3}}(?:\.\d+)?)\s*{unit}", t)
+    m = _AREA_RE.search(t)
     if m:
         try:
             val = float(m.group(1))
@@ -127,26 +139,18 @@ def extract_area_m2(text: str) -> Optional[float]:
 
     return None
 
-def extract_extras(text: str) -> List[str]:
-    t = text.lower()
-    extras = []
-    for extra_name, keys in EXTRA_ALIASES.items():
-        for k in keys:
-            if k in t:
-                extras.append(extra_name)
-                break
-    # уникализируем сохранив порядок
-    seen = set()
-    out = []
-    for e in extras:
-        if e not in seen:
-            seen.add(e)
-            out.append(e)
-    return out
+def extract_extras(text: str, low: Optional[str] = None) -> List[str]:
+    t = low if low is not None else text.lower()
+    # ключи EXTRA_ALIASES уникальны — результат уже без повторов и в порядке словаря;
+    # any() останавливается на первом совпавшем алиасе, сам поиск — C-шный `in`
+    return [name for name, keys in EXTRA_ALIASES.items() if any(k in t for k in keys)]
 
 def extract_info(text: str) -> ExtractedInfo:
+    # lower() и замены — один раз на сообщение, а не в каждом экстракторе
+    low = (text or "").lower()
+    norm = low.translate(_NORM_TABLE)
     return ExtractedInfo(
-        area_m2=extract_area_m2(text),
-        extras=extract_extras(text),
-        extras_counts=extract_extras_counts(text),
+        area_m2=extract_area_m2(text, norm),
+        extras=extract_extras(text, low),
+        extras_counts=extract_extras_counts(text, norm),
     )
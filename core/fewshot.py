@@ -110,6 +110,10 @@ class FewShotManager:
 
     def select(self, user_text: str, mem: Optional[Dict[str, Any]] = None, k: int = 4) -> List[Dict[str, str]]:
         """Возвращает сообщения few-shot (user/assistant), которые вставляются в начало контекста."""
+        return self.messages(self.pick(user_text, mem=mem, k=k))
+
+    def pick(self, user_text: str, mem: Optional[Dict[str, Any]] = None, k: int = 4) -> List[int]:
+        """Индексы выбранных примеров — их можно сохранить в mem и переиспользовать (см. messages)."""
 
         if not self.examples or not (user_text or "").strip() or k <= 0:
             return []
@@ -119,9 +123,9 @@ class FewShotManager:
         service_hint = "sound" if service == "soundproof" else "ceiling"
 
         q_tokens = _tokenize(user_text)
-        scored: List[Tuple[float, FewShotExample]] = []
+        scored: List[Tuple[float, int]] = []
 
-        for ex in self.examples:
+        for i, ex in enumerate(self.examples):
             ex_tokens = _tokenize(ex.user_text)
             score = _jaccard(q_tokens, ex_tokens)
 
@@ -133,16 +137,19 @@ class FewShotManager:
                 score += 0.03
 
             if score > 0:
-                scored.append((score, ex))
+                scored.append((score, i))
 
         scored.sort(key=lambda x: x[0], reverse=True)
-        picked = [ex for _, ex in scored[: min(len(scored), k)]]
+        picked = [i for _, i in scored[: min(len(scored), k)]]
 
         # если совсем ничего не нашлось — вернём 1–2 самых “универсальных” примера
         if not picked:
-            picked = self.examples[: min(2, len(self.examples))]
+            picked = list(range(min(2, len(self.examples))))
+        return picked
 
+    def messages(self, ids: List[int]) -> List[Dict[str, str]]:
         out: List[Dict[str, str]] = []
-        for ex in picked:
-            out.extend(ex.messages)
+        for i in ids:
+            if isinstance(i, int) and 0 <= i < len(self.examples):
+                out.extend(self.examples[i].messages)
         return out
@@ -1,5 +1,6 @@
+from collections import deque
 from dataclasses import dataclass
-from typing import List, Dict, Optional
+from typing import Deque, List, Dict, Optional
 
 @dataclass
 class ChatMessage:
@@ -9,25 +10,24 @@ class ChatMessage:
 class ChatHistory:
     def __init__(self, system_prompt: str, max_messages: int = 20):
         self.max_messages = max_messages
-        self.messages: List[ChatMessage] = [ChatMessage("system", system_prompt)]
+        # храним сразу в формате Ollama: to_ollama_messages() не собирает dict'ы заново на каждом ходе.
+        # Эти dict'ы общие с возвращаемыми списками — их можно заменять в списке, но не менять на месте.
+        self._system = {"role": "system", "content": system_prompt}
+        # deque с maxlen: старые сообщения вытесняются за O(1), без пересборки списка на каждом ходе
+        self._tail: Deque[Dict[str, str]] = deque(maxlen=max_messages if max_messages > 0 else None)
+
+    @property
+    def messages(self) -> List[ChatMessage]:
+        return [ChatMessage(m["role"], m["content"]) for m in (self._system, *self._tail)]
 
     def add_user(self, text: str):
-        self.messages.append(ChatMessage("user", text))
-        self._trim()
+        self._tail.append({"role": "user", "content": text})
 
     def add_assistant(self, text: str):
-        self.messages.append(ChatMessage("assistant", text))
-        self._trim()
-
-    def _trim(self):
-        if len(self.messages) <= 1 + self.max_messages:
-            return
-        system = self.messages[0]
-        tail = self.messages[-self.max_messages:]
-        self.messages = [system] + tail
+        self._tail.append({"role": "assistant", "content": text})
 
     def to_ollama_messages(self) -> List[Dict[str, str]]:
-        return [{"role": m.role, "content": m.content} for m in self.messages]
+        return [self._system, *self._tail]
 
     def to_ollama_messages_with_context(self, context: str) -> List[Dict[str, str]]:
         """
@@ -12,16 +12,20 @@ class IntentDetector:
     COMPLAINT = "complaint"
     GENERAL = "general"
 
+    _COMPLAINT_RE = re.compile(r"\b(дорого|жалоб|плох|обман|верните|не\s+доволен|мошенн)\b")
+    _PRICE_RE = re.compile(r"\b(сколько|цена|стоим|стоить|прайс|расч(е|ё)т|м2|м²|кв\.?\s*м|кв\b|квм\b)\b")
+    _BOOKING_RE = re.compile(r"\b(когда|запис|замер|приех|встреч|контакт|телефон|адрес)\b")
+
     def detect(self, text: str) -> IntentResult:
         t = text.lower()
 
-        if re.search(r"\b(дорого|жалоб|плох|обман|верните|не\s+доволен|мошенн)\b", t):
+        if self._COMPLAINT_RE.search(t):
             return IntentResult(self.COMPLAINT, 0.85)
 
-        if re.search(r"\b(сколько|цена|стоим|стоить|прайс|расч(е|ё)т|м2|м²|кв\.?\s*м|кв\b|квм\b)\b", t):
+        if self._PRICE_RE.search(t):
             return IntentResult(self.PRICE, 0.8)
 
-        if re.search(r"\b(когда|запис|замер|приех|встреч|контакт|телефон|адрес)\b", t):
+        if self._BOOKING_RE.search(t):
             return IntentResult(self.BOOKING, 0.8)
 
         return IntentResult(self.GENERAL, 0.6)
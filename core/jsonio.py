@@ -0,0 +1,33 @@
+# core/jsonio.py
+"""
+Быстрый JSON: orjson, если установлен, иначе стандартный json.
+
+orjson разбирает bytes напрямую (без промежуточного decode в str) и в разы быстрее stdlib —
+это заметно на больших ответах Авито (список из 100 чатов с last_message).
+"""
+from __future__ import annotations
+
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson опционален
+    orjson = None  # type: ignore[assignment]
+
+
+def loads(data: Union[bytes, bytearray, str]) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any, indent: bool = False) -> bytes:
+    """UTF-8 JSON без \\u-экранирования кириллицы (как json.dumps(..., ensure_ascii=False))."""
+    if orjson is not None:
+        opts = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        try:
+            return orjson.dumps(obj, option=opts)
+        except TypeError:
+            pass  # то, что orjson не умеет (например, int > 64 бит) — через stdlib
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None).encode("utf-8")
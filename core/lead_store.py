@@ -1,11 +1,14 @@
 # core/lead_store.py
-import json
+import atexit
 import os
 import re
+import threading
 import time
 from pathlib import Path
 from typing import Any, Dict, Optional
 
+from core import jsonio
+
 
 class LeadStoreTxt:
     def __init__(self, path: str = "data/leads.txt", leads_dir: str = "data/leads") -> None:
@@ -16,6 +19,12 @@ class LeadStoreTxt:
 
         self.last_path: Optional[str] = None
 
+        # Один открытый на весь процесс дескриптор с построчной буферизацией:
+        # на заявку — один write(), без open/close. Лок — append зовут из разных потоков.
+        self._fh = open(self.path, "a", buffering=1, encoding="utf-8")
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
     @staticmethod
     def _safe(s: str) -> str:
         s = (s or "").strip()
@@ -45,17 +54,24 @@ class LeadStoreTxt:
             f"address={lead.get('address','-')} "
             f"phone={lead.get('phone','-')}\n"
         )
-        with open(self.path, "a", encoding="utf-8") as f:
-            f.write(line)
+        with self._lock:
+            self._fh.write(line)
 
         fname = f"lead_{ts}_{platform}_{user_id}_{city}.json"
         fpath = str(Path(self.leads_dir) / fname)
-        with open(fpath, "w", encoding="utf-8") as f:
-            json.dump(lead, f, ensure_ascii=False, indent=2)
+        with open(fpath, "wb") as f:
+            f.write(jsonio.dumps(lead, indent=True))
 
         self.last_path = fpath
         return fpath
 
+    def close(self) -> None:
+        with self._lock:
+            try:
+                self._fh.close()
+            except Exception:
+                pass
+
 
 class LeadStoreJsonl:
     """Append-only store for lead events.
@@ -69,5 +85,5 @@ class LeadStoreJsonl:
         os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
 
     def append(self, event: Dict[str, Any]) -> None:
-        with open(self.path, "a", encoding="utf-8") as f:
-            f.write(json.dumps(event, ensure_ascii=False) + "\n")
\ No newline at end of file
+        with open(self.path, "ab") as f:
+            f.write(jsonio.dumps(event) + b"\n")
\ No newline at end of file
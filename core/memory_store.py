@@ -1,7 +1,14 @@
-import json
+import atexit
+import copy
 import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
 from typing import Any, Dict
 
+from core import jsonio
+
 class FileKVStore:
     def __init__(self, dir_path: str = "data/memory"):
         self.dir_path = dir_path
@@ -16,15 +23,207 @@ class FileKVStore:
         if not os.path.exists(p):
             return {}
         try:
-            with open(p, "r", encoding="utf-8") as f:
-                return json.load(f) or {}
+            with open(p, "rb") as f:
+                return jsonio.loads(f.read()) or {}
         except Exception:
             return {}
 
-    def save(self, key: str, data: Dict[str, Any]) -> None:
+    def save(self, key: str, data: Dict[str, Any], owned: bool = False) -> None:
+        # owned — для совместимости с BufferedKVStore: пишем сразу, копия не нужна
         p = self._path(key)
-        with open(p, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        raw = jsonio.dumps(data, indent=True)
+        with open(p, "wb") as f:
+            f.write(raw)
+
+    def reset(self, key: str) -> None:
+        self.save(key, {})
+
+
+class SqliteKVStore:
+    """
+    Тот же интерфейс, что у FileKVStore, но все ключи в одной SQLite-базе (WAL).
+
+    Читатели работают параллельно (своё соединение на поток), записи идут по одной
+    под общим локом — вместо сотен мелких JSON-файлов, перезаписываемых целиком.
+    """
+
+    def __init__(self, db_path: str = "data/memory.sqlite3"):
+        self.db_path = db_path
+        self.dir_path = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(self.dir_path, exist_ok=True)
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS mem (k TEXT PRIMARY KEY, v TEXT NOT NULL, updated_at INTEGER)")
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            self._local.conn = conn
+        return conn
+
+    def load(self, key: str) -> Dict[str, Any]:
+        try:
+            row = self._conn().execute("SELECT v FROM mem WHERE k = ?", (key,)).fetchone()
+        except Exception:
+            return {}
+        if not row:
+            return {}
+        try:
+            return jsonio.loads(row[0]) or {}
+        except Exception:
+            return {}
+
+    def save(self, key: str, data: Dict[str, Any], owned: bool = False) -> None:
+        v = jsonio.dumps(data).decode("utf-8")
+        with self._write_lock:
+            conn = self._conn()
+            conn.execute(
+                "INSERT INTO mem (k, v, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(k) DO UPDATE SET v = excluded.v, updated_at = excluded.updated_at",
+                (key, v, int(time.time())),
+            )
+            conn.commit()
 
     def reset(self, key: str) -> None:
         self.save(key, {})
+
+
+class BufferedKVStore:
+    """
+    Write-behind поверх FileKVStore/SqliteKVStore: save() только запоминает данные, на диск они уходят
+    раз в flush_interval секунд (и при выходе процесса). Серия save() одного ключа
+    за время окна — одна запись файла вместо N.
+
+    load() видит ещё не записанные данные, так что для вызывающего кода всё как раньше.
+    Уже записанные ключи держим в LRU (max_clean), чтобы каждый ход не перечитывать файл.
+
+    Диск читаем без _lock; чтобы прочитанная старая версия не попала в LRU поверх более
+    свежего save()/reset(), у ключей есть номер версии (_gen), его сверяем перед вставкой.
+    """
+
+    def __init__(self, store: Any, flush_interval: float = 1.0, max_clean: int = 2048):
+        self.store = store
+        self.dir_path = store.dir_path
+        self.flush_interval = max(0.05, float(flush_interval))
+        self.max_clean = max(0, int(max_clean))
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._clean: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # key -> номер последнего save()/reset(); живёт, пока ключ в _pending/_clean
+        self._gen: Dict[str, int] = {}
+        self._seq = 0
+        # максимальный номер среди забытых ключей: читатели, начавшие раньше, в LRU не пишут
+        self._floor = 0
+        # сериализует записи на диск (flush и reset), чтобы старая версия не легла поверх reset
+        self._io_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, name="mem-flush", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # _bump/_forget/_remember_clean вызываются под _lock
+    def _bump(self, key: str) -> None:
+        self._seq += 1
+        self._gen[key] = self._seq
+
+    def _forget(self, key: str) -> None:
+        g = self._gen.pop(key, None)
+        if g is not None and g > self._floor:
+            self._floor = g
+
+    def _remember_clean(self, key: str, data: Dict[str, Any]) -> None:
+        if not self.max_clean:
+            self._forget(key)
+            return
+        self._clean[key] = data
+        self._clean.move_to_end(key)
+        while len(self._clean) > self.max_clean:
+            old, _ = self._clean.popitem(last=False)
+            self._forget(old)
+
+    def load(self, key: str) -> Dict[str, Any]:
+        # объекты в _pending/_clean никто не меняет, поэтому копируем уже без лока
+        with self._lock:
+            data = self._pending.get(key)
+            if data is None:
+                data = self._clean.get(key)
+                if data is not None:
+                    self._clean.move_to_end(key)
+            start = self._seq
+        if data is not None:
+            return copy.deepcopy(data)
+
+        data = self.store.load(key)
+        with self._lock:
+            fresh = (
+                key not in self._pending
+                and key not in self._clean
+                and self._gen.get(key, 0) <= start
+                and self._floor <= start
+            )
+            if fresh:
+                self._remember_clean(key, data)
+        return copy.deepcopy(data) if fresh else data
+
+    def save(self, key: str, data: Dict[str, Any], owned: bool = False) -> None:
+        """
+        owned=True — вызывающий код отдаёт data и больше её не меняет (save перед return):
+        тогда обходимся без копии. Иначе копируем, т.к. mem продолжают менять после save.
+        """
+        snap = data if owned else copy.deepcopy(data)
+        with self._lock:
+            self._pending[key] = snap
+            self._clean.pop(key, None)
+            self._bump(key)
+
+    def reset(self, key: str) -> None:
+        # запись на диск — под _io_lock (не под _lock), чтобы не стопорить load()/save() других ключей
+        with self._io_lock:
+            with self._lock:
+                self._pending.pop(key, None)
+                self._clean.pop(key, None)
+                self._bump(key)
+            try:
+                self.store.reset(key)
+            finally:
+                with self._lock:
+                    # читатели, успевшие прочитать файл до reset, не положат его в LRU
+                    self._bump(key)
+                    if key not in self._pending:
+                        self._forget(key)
+
+    def flush(self) -> None:
+        with self._lock:
+            batch = list(self._pending.items())
+        for key, data in batch:
+            with self._io_lock:
+                with self._lock:
+                    if self._pending.get(key) is not data:
+                        continue  # уже есть более свежая версия или был reset
+                try:
+                    self.store.save(key, data)
+                except Exception:
+                    continue
+                with self._lock:
+                    # убираем, только если за время записи не пришла более свежая версия
+                    if self._pending.get(key) is data:
+                        del self._pending[key]
+                        self._remember_clean(key, data)
+
+    def _flush_loop(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                pass
+
+    def close(self) -> None:
+        self._stop.set()
+        self.flush()
+
@@ -13,12 +13,23 @@ Env knobs:
 - OLLAMA_CONNECT_TIMEOUT (seconds)
 - OLLAMA_READ_TIMEOUT (seconds)
 - OLLAMA_RETRIES (default 0)
+- OLLAMA_NUM_PARALLEL (default 4) — max concurrent requests from this process;
+  keep it equal to the server's OLLAMA_NUM_PARALLEL so the runner batches them
+- OLLAMA_NUM_CTX (default 0 = server default) — context window per request.
+  KV-cache size grows linearly with it; this bot's prompts fit in 2048.
+  Use together with a quantized model tag (e.g. *-q4_K_M) and, on the server,
+  OLLAMA_KV_CACHE_TYPE=q8_0 + OLLAMA_FLASH_ATTENTION=1.
+- OLLAMA_NUM_KEEP (default "auto") — tokens of the prompt head kept when the
+  context shifts. "auto" = estimated size of the leading system prompt (it is
+  identical on every turn), a number = fixed value, 0 = don't send.
 
 Legacy compatibility:
 - `timeout` and `request_timeout` are treated as READ timeout caps.
 """
 
 import os
+import threading
+from functools import lru_cache
 from typing import Dict, List, Optional, Tuple, Union
 
 import requests
@@ -28,6 +39,13 @@ from requests import exceptions as req_exc
 TimeoutT = Union[int, float, Tuple[float, float]]  # (connect, read)
 
 
+@lru_cache(maxsize=8)
+def _approx_prompt_tokens(text: str) -> int:
+    # без токенизатора: для русского текста ~3 символа на токен; промпт один и тот же,
+    # поэтому считаем один раз на его содержимое
+    return max(1, len(text) // 3)
+
+
 class LLMTimeoutError(TimeoutError):
     """Raised when the LLM didn't respond within timeout."""
 
@@ -68,14 +86,53 @@ class OllamaClient:
         except Exception:
             self.retries = 0
 
+        # generate_reply зовётся из нескольких потоков (tg/vk/avito): разные пользователи идут
+        # параллельно, но не больше, чем сервер обрабатывает одновременно — лишние ждут слота
+        # здесь, а не в очереди Ollama с риском read timeout.
+        try:
+            parallel = int(os.getenv("OLLAMA_NUM_PARALLEL", "4") or "4")
+        except Exception:
+            parallel = 4
+        self._slots = threading.BoundedSemaphore(max(1, parallel))
+
+        try:
+            self.num_ctx = int(os.getenv("OLLAMA_NUM_CTX", "0") or "0")
+        except Exception:
+            self.num_ctx = 0
+
+        raw_keep = (os.getenv("OLLAMA_NUM_KEEP", "auto") or "auto").strip().lower()
+        try:
+            self.num_keep: Optional[int] = None if raw_keep == "auto" else int(raw_keep)
+        except Exception:
+            self.num_keep = None
+
+        # keep-alive к Ollama вместо нового TCP-соединения на каждый запрос
+        self._session = requests.Session()
+
+    def _num_keep(self, messages: List[Dict[str, str]]) -> int:
+        if self.num_keep is not None:
+            return self.num_keep
+        if messages and messages[0].get("role") == "system":
+            return _approx_prompt_tokens(messages[0].get("content") or "")
+        return 0
+
     def chat(self, messages: List[Dict[str, str]]) -> str:
         url = f"{self.base_url}/api/chat"
         payload = {"model": self.model, "messages": messages, "stream": False}
+        options: Dict[str, int] = {}
+        if self.num_ctx > 0:
+            options["num_ctx"] = self.num_ctx
+        num_keep = self._num_keep(messages)
+        if num_keep > 0:
+            options["num_keep"] = num_keep
+        if options:
+            payload["options"] = options
 
         last_err: Optional[Exception] = None
         for _attempt in range(self.retries + 1):
             try:
-                r = requests.post(url, json=payload, timeout=self.timeout)
+                with self._slots:
+                    r = self._session.post(url, json=payload, timeout=self.timeout)
                 r.raise_for_status()
                 data = r.json()
                 return data["message"]["content"]